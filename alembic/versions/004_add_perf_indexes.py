@@ -0,0 +1,32 @@
+"""Add performance indexes for token revocation and chat history lookups
+
+Revision ID: 004
+Revises: 654bbf43c41d
+Create Date: 2026-10-15 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '004'
+down_revision = '654bbf43c41d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Partial index for revoking a user's still-active tokens
+    op.create_index(
+        'ix_tokens_user_active', 'tokens', ['user_id', 'is_revoked'],
+        postgresql_where=sa.text('is_revoked = false')
+    )
+    
+    # Composite index so history queries are an index range scan with no sort
+    op.create_index('ix_chat_messages_session_created', 'chat_messages', ['session_id', 'created_at'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_chat_messages_session_created', table_name='chat_messages')
+    op.drop_index('ix_tokens_user_active', table_name='tokens')
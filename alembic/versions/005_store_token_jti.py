@@ -0,0 +1,80 @@
+"""Store token jti and expiry instead of the raw JWT
+
+Revision ID: 005
+Revises: 004
+Create Date: 2026-10-15 11:00:00.000000
+
+"""
+from datetime import datetime, timezone
+from alembic import op
+import sqlalchemy as sa
+import jwt
+from jwt import InvalidTokenError
+
+
+# revision identifiers, used by Alembic.
+revision = '005'
+down_revision = '004'
+branch_labels = None
+depends_on = None
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+def upgrade() -> None:
+    op.add_column('tokens', sa.Column('jti', sa.String(length=32), nullable=True))
+    op.add_column('tokens', sa.Column('expires_at', sa.DateTime(timezone=True), nullable=True))
+    
+    # Every stored token predates the jti claim, so its ID is md5(token), matching
+    # auth._token_jti; that needs no per-row work
+    op.execute("UPDATE tokens SET jti = md5(token)")
+    
+    # expires_at needs the exp claim, so decode in Python and write back in batches
+    conn = op.get_bind()
+    tokens = sa.table(
+        'tokens',
+        sa.column('id', sa.Integer),
+        sa.column('token', sa.Text),
+        sa.column('expires_at', sa.DateTime(timezone=True)),
+    )
+    set_expiry = tokens.update().where(tokens.c.id == sa.bindparam('token_id')).values(
+        expires_at=sa.bindparam('token_expires_at')
+    )
+    result = conn.execute(
+        sa.select(tokens.c.id, tokens.c.token).execution_options(yield_per=BACKFILL_BATCH_SIZE)
+    )
+    for rows in result.partitions():
+        batch = []
+        for token_id, token in rows:
+            try:
+                exp = jwt.decode(token, options={"verify_signature": False}).get('exp')
+            except InvalidTokenError:
+                exp = None
+            if exp:
+                batch.append({
+                    'token_id': token_id,
+                    'token_expires_at': datetime.fromtimestamp(exp, tz=timezone.utc),
+                })
+        if batch:
+            conn.execute(set_expiry, batch)
+    
+    op.alter_column('tokens', 'jti', nullable=False)
+    op.create_index('ix_tokens_jti', 'tokens', ['jti'], unique=True)
+    op.create_index('ix_tokens_expires_at', 'tokens', ['expires_at'], unique=False)
+    
+    # Drop the raw token column and its index
+    op.drop_index('ix_tokens_token', table_name='tokens')
+    op.drop_column('tokens', 'token')
+
+
+def downgrade() -> None:
+    # Raw tokens can't be recovered; old rows keep their jti as a placeholder
+    op.add_column('tokens', sa.Column('token', sa.Text(), nullable=True))
+    op.execute("UPDATE tokens SET token = jti")
+    op.alter_column('tokens', 'token', nullable=False)
+    op.create_index('ix_tokens_token', 'tokens', ['token'], unique=True)
+    
+    op.drop_index('ix_tokens_expires_at', table_name='tokens')
+    op.drop_index('ix_tokens_jti', table_name='tokens')
+    op.drop_column('tokens', 'expires_at')
+    op.drop_column('tokens', 'jti')
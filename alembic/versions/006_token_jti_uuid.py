@@ -0,0 +1,36 @@
+"""Store tokens.jti as a native UUID
+
+Revision ID: 006
+Revises: 005
+Create Date: 2026-10-15 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '006'
+down_revision = '005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Every jti is 32 hex chars (token_hex(16) or md5 of a legacy token), so it casts directly
+    op.alter_column(
+        'tokens', 'jti',
+        existing_type=sa.String(length=32),
+        type_=postgresql.UUID(as_uuid=True),
+        postgresql_using='jti::uuid'
+    )
+
+
+def downgrade() -> None:
+    op.alter_column(
+        'tokens', 'jti',
+        existing_type=postgresql.UUID(as_uuid=True),
+        type_=sa.String(length=32),
+        postgresql_using="replace(jti::text, '-', '')"
+    )
@@ -1,12 +1,24 @@
-from datetime import datetime, timedelta
-from typing import Optional
-from jose import JWTError, jwt
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
+import hashlib
+import hmac
+import threading
+import time
+import secrets
+import uuid
+from cachetools import TTLCache
+import jwt
+from jwt import InvalidTokenError
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy import exists, insert, select, update
+from sqlalchemy.orm import Session, defer
 from database import get_db
 from models import User, Token
+from revocation import token_revocation_store, RevocationError
 import os
 
 # Configuration
@@ -16,60 +28,175 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 REFRESH_TOKEN_EXPIRE_DAYS = 7
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Password hashing: argon2id (OWASP parameters) via argon2-cffi for new hashes.
+# passlib is kept only to verify legacy bcrypt hashes, which are transparently
+# upgraded on the next successful login.
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+legacy_pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# Verification cache: password hashing is deliberately slow, so remember recent results.
+# Keyed by HMAC(hashed_password, plain_password) so plaintext is never stored and
+# a password change (new hash) naturally misses the cache.
+_verify_cache = TTLCache(maxsize=10_000, ttl=300)
+_verify_cache_lock = threading.Lock()
+
+# Decoded access tokens, keyed by a digest of the raw token. Only successful
+# verifications are cached; revocation is still checked on every request.
+_jwt_cache = TTLCache(maxsize=50_000, ttl=30)
+_jwt_cache_lock = threading.Lock()
+
+# Recent WebSocket authentications, jti -> user id. Clients reconnect often with the
+# same token; a hit still checks the token's revocation and the user's token_version
+# and active flag (one primary-key lookup), so logouts on any worker apply immediately.
+_ws_auth_cache = TTLCache(maxsize=10_000, ttl=30)
+_ws_auth_cache_lock = threading.Lock()
 
 # Security
 security = HTTPBearer()
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+def verify_password(
+    plain_password: str,
+    hashed_password: str,
+    db: Optional[Session] = None,
+    user: Optional[User] = None
+) -> bool:
+    """
+    Verify a password; when db and user are given, legacy hashes are upgraded in place
+    """
+    key = hmac.new(hashed_password.encode(), plain_password.encode(), hashlib.sha256).digest()
+    with _verify_cache_lock:
+        cached = _verify_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    # Cache failures too, so repeated bad guesses don't each cost a full hash run
+    new_hash = None
+    if hashed_password.startswith("$argon2"):
+        try:
+            result = password_hasher.verify(hashed_password, plain_password)
+        except (VerificationError, InvalidHashError):
+            result = False
+        if result and password_hasher.check_needs_rehash(hashed_password):
+            new_hash = password_hasher.hash(plain_password)
+    else:
+        result = legacy_pwd_context.verify(plain_password, hashed_password)
+        if result:
+            new_hash = password_hasher.hash(plain_password)
+    
+    if new_hash and db is not None and user is not None:
+        user.hashed_password = new_hash
+        db.commit()
+    with _verify_cache_lock:
+        _verify_cache[key] = result
+    return result
 
 def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+    return password_hasher.hash(password)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire, "type": "access"})
+    # Integer epoch seconds, which is what the JWT library would convert a datetime to anyway
+    if expires_delta is None:
+        expires_delta = timedelta(minutes=15)
+    expire = int(time.time() + expires_delta.total_seconds())
+    to_encode.update({"exp": expire, "type": "access", "jti": secrets.token_hex(16)})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 def create_refresh_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
-    to_encode.update({"exp": expire, "type": "refresh"})
+    if expires_delta is None:
+        expires_delta = timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    expire = int(time.time() + expires_delta.total_seconds())
+    to_encode.update({"exp": expire, "type": "refresh", "jti": secrets.token_hex(16)})
     encoded_jwt = jwt.encode(to_encode, REFRESH_SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def verify_token(token: str) -> Optional[str]:
+def _token_jti(token: str, payload: dict) -> str:
+    """Token ID (32 hex chars, stored as a UUID); tokens issued before jti existed use md5(token)"""
+    return payload.get("jti") or hashlib.md5(token.encode()).hexdigest()
+
+def verify_token(token: str) -> Optional[Tuple[str, str, Optional[int], int]]:
+    """Return (email, jti, exp, token_version) for a valid access token, otherwise None"""
+    cache_key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    with _jwt_cache_lock:
+        cached = _jwt_cache.get(cache_key)
+    if cached is not None:
+        exp = cached[2]
+        if exp is None or exp > time.time():
+            return cached
+    
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
         token_type: str = payload.get("type")
         if email is None or token_type != "access":
             return None
-        return email
-    except JWTError:
+        verified = (email, _token_jti(token, payload), payload.get("exp"), payload.get("ver", 0))
+        with _jwt_cache_lock:
+            _jwt_cache[cache_key] = verified
+        return verified
+    except InvalidTokenError:
         return None
 
-def verify_refresh_token(token: str) -> Optional[str]:
+def verify_refresh_token(token: str) -> Optional[Tuple[str, str, Optional[int], int]]:
+    """Return (email, jti, exp, token_version) for a valid refresh token, otherwise None"""
     try:
         payload = jwt.decode(token, REFRESH_SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
         token_type: str = payload.get("type")
         if email is None or token_type != "refresh":
             return None
-        return email
-    except JWTError:
+        return email, _token_jti(token, payload), payload.get("exp"), payload.get("ver", 0)
+    except InvalidTokenError:
         return None
 
+def is_token_revoked(db: Session, jti: str) -> bool:
+    """Check revocation in the revocation store when it can answer, falling back to the database"""
+    revoked = token_revocation_store.is_revoked(jti)
+    if revoked is not None:
+        return revoked
+    revoked = db.query(
+        exists().where(Token.jti == uuid.UUID(jti), Token.is_revoked == True)
+    ).scalar()
+    token_revocation_store.remember(jti, revoked)
+    return revoked
+
+def get_unrevoked_user(db: Session, email: str, jti: str, token_version: int = 0) -> Optional[User]:
+    """
+    Load the token's user, or None if the token is revoked, was issued before the
+    user's last bulk revocation (token_version mismatch) or the user doesn't exist
+    """
+    revoked = token_revocation_store.is_revoked(jti)
+    if revoked:
+        return None
+    
+    # The password hash and updated_at are never needed once a request is token-authenticated
+    query = db.query(User).options(defer(User.hashed_password), defer(User.updated_at)).filter(User.email == email)
+    if revoked is None:
+        # No cached or Redis answer: fold the revocation check into the user lookup (one round-trip)
+        query = query.filter(~exists().where(Token.jti == uuid.UUID(jti), Token.is_revoked == True))
+    user = query.first()
+    if revoked is None and user is not None:
+        token_revocation_store.remember(jti, False)
+    if user is not None and user.token_version != token_version:
+        return None
+    return user
+
+def _token_claims(token: str) -> Tuple[Optional[str], Optional[int]]:
+    """Read (jti, exp) from a token we issued without re-verifying its signature"""
+    try:
+        claims = jwt.decode(token, options={"verify_signature": False})
+        return _token_jti(token, claims), claims.get("exp")
+    except InvalidTokenError:
+        return None, None
+
+def token_row(user_id: int, token: str, token_type: str) -> dict:
+    """Column values for a tokens row describing an issued token"""
+    jti, exp = _token_claims(token)
+    expires_at = datetime.fromtimestamp(exp, tz=timezone.utc) if exp else None
+    return {"user_id": user_id, "jti": uuid.UUID(jti), "expires_at": expires_at, "token_type": token_type}
+
 def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
     db: Session = Depends(get_db)
@@ -81,16 +208,12 @@ def get_current_user(
     )
     
     token = credentials.credentials
-    email = verify_token(token)
-    if email is None:
-        raise credentials_exception
-    
-    # Check if token is revoked
-    db_token = db.query(Token).filter(Token.token == token, Token.is_revoked == True).first()
-    if db_token:
+    verified = verify_token(token)
+    if verified is None:
         raise credentials_exception
+    email, jti, _, token_version = verified
     
-    user = db.query(User).filter(User.email == email).first()
+    user = get_unrevoked_user(db, email, jti, token_version)
     if user is None:
         raise credentials_exception
     return user
@@ -105,16 +228,12 @@ def get_current_active_user_ws(token: str, db: Session) -> Optional[User]:
     Authenticate user for WebSocket connection
     """
     try:
-        email = verify_token(token)
-        if email is None:
+        verified = verify_token(token)
+        if verified is None:
             return None
+        email, jti, _, token_version = verified
         
-        # Check if token is revoked
-        db_token = db.query(Token).filter(Token.token == token, Token.is_revoked == True).first()
-        if db_token:
-            return None
-        
-        user = db.query(User).filter(User.email == email).first()
+        user = get_unrevoked_user(db, email, jti, token_version)
         if user is None or not user.is_active:
             return None
         
@@ -122,20 +241,61 @@ def get_current_active_user_ws(token: str, db: Session) -> Optional[User]:
     except Exception:
         return None
 
+def get_active_user_id_ws(token: str, db: Session) -> Optional[int]:
+    """
+    Authenticate a WebSocket connection and return the user's id, or None. Successful
+    lookups are remembered per token for 30 seconds so reconnects skip the full user load.
+    """
+    try:
+        verified = verify_token(token)
+        if verified is None:
+            return None
+        _, jti, _, token_version = verified
+        
+        with _ws_auth_cache_lock:
+            user_id = _ws_auth_cache.get(jti)
+        # A hit only counts if the revocation store can vouch for the token without the
+        # database and no bulk revocation (token_version bump) or deactivation happened since
+        if user_id is not None and token_revocation_store.is_revoked(jti) is False:
+            current = db.execute(
+                select(User.token_version, User.is_active).where(User.id == user_id)
+            ).first()
+            if current is not None and current.token_version == token_version and current.is_active:
+                return user_id
+            with _ws_auth_cache_lock:
+                _ws_auth_cache.pop(jti, None)
+            return None
+        
+        user = get_current_active_user_ws(token, db)
+        if user is None:
+            return None
+        with _ws_auth_cache_lock:
+            _ws_auth_cache[jti] = user.id
+        return user.id
+    except Exception:
+        return None
+
 def save_token_to_db(db: Session, user_id: int, access_token: str, refresh_token: str):
-    # Save access token
-    access_db_token = Token(user_id=user_id, token=access_token, token_type="access")
-    db.add(access_db_token)
-    
-    # Save refresh token
-    refresh_db_token = Token(user_id=user_id, token=refresh_token, token_type="refresh")
-    db.add(refresh_db_token)
-    
+    # Both rows go in one INSERT, without building ORM objects nobody reads back
+    rows = [
+        token_row(user_id, access_token, "access"),
+        token_row(user_id, refresh_token, "refresh"),
+    ]
+    db.execute(insert(Token), rows)
     db.commit()
-    return {"access_token": access_db_token, "refresh_token": refresh_db_token}
+    return rows
 
 def revoke_token(db: Session, token: str):
-    db_token = db.query(Token).filter(Token.token == token).first()
+    """
+    Revoke one token. The revocation store is written first and a RevocationError
+    propagates before anything is committed, so the database never records a
+    revocation that other workers can't see.
+    """
+    jti, exp = _token_claims(token)
+    if jti is None:
+        return None
+    token_revocation_store.revoke(jti, exp)
+    db_token = db.query(Token).filter(Token.jti == uuid.UUID(jti)).first()
     if db_token:
         db_token.is_revoked = True
         db.commit()
@@ -143,8 +303,51 @@ def revoke_token(db: Session, token: str):
 
 def revoke_user_tokens(db: Session, user_id: int):
     """Revoke all tokens for a user (useful for logout)"""
-    tokens = db.query(Token).filter(Token.user_id == user_id, Token.is_revoked == False).all()
-    for token in tokens:
-        token.is_revoked = True
+    # Bumping token_version invalidates every outstanding token at once: the version
+    # check rides on the user row each request loads anyway, so nothing needs to be
+    # pushed to the revocation store. The rows are still marked for the record.
+    db.execute(
+        update(User).where(User.id == user_id).values(token_version=User.token_version + 1)
+    )
+    revoked_count = db.execute(
+        update(Token)
+        .where(Token.user_id == user_id, Token.is_revoked == False)
+        .values(is_revoked=True)
+    ).rowcount
+    db.commit()
+    return revoked_count
+
+def load_revoked_tokens(db: Session):
+    """
+    Rehydrate the revocation store from the database (e.g. after a Redis restart).
+
+    Only the first worker to start against a given Redis does this: the marker key has no
+    expiry, so it disappears exactly when Redis loses its data and rehydration is needed again.
+    """
+    if not token_revocation_store.enabled:
+        return
+    if not token_revocation_store.claim("rehydrate_revoked_tokens"):
+        return
+    try:
+        revoked = db.query(Token.jti, Token.expires_at).filter(
+            Token.is_revoked == True,
+            Token.expires_at > datetime.now(timezone.utc)
+        ).all()
+        token_revocation_store.revoke_many(
+            ((jti.hex, int(expires_at.timestamp())) for jti, expires_at in revoked),
+            publish=False
+        )
+    except RevocationError as e:
+        token_revocation_store.release("rehydrate_revoked_tokens")
+        print(str(e))
+    except Exception:
+        token_revocation_store.release("rehydrate_revoked_tokens")
+        raise
+
+def purge_expired_tokens(db: Session) -> int:
+    """Delete token rows past their expiry; they can no longer authenticate anyway"""
+    deleted = db.query(Token).filter(
+        Token.expires_at < datetime.now(timezone.utc)
+    ).delete(synchronize_session=False)
     db.commit()
-    return tokens 
\ No newline at end of file
+    return deleted
\ No newline at end of file
@@ -1,12 +1,12 @@
-import uuid
+import secrets
 import json
-from typing import Dict, Any, List, Optional
-from sqlalchemy.orm import Session
-from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, AsyncIterator
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session, selectinload
+from datetime import datetime, timedelta, timezone
 
 from models import ChatSession, ChatMessage, ConversationContext
-from llm_integration import llm_integration
-from tools import chatbot_tools
+from llm_integration import get_llm_integration
 
 class ChatbotOrchestrator:
     def __init__(self):
@@ -15,7 +15,8 @@ class ChatbotOrchestrator:
     
     def create_session(self, db: Session, user_id: int, title: str = None) -> ChatSession:
         """Create a new chat session"""
-        session_id = str(uuid.uuid4())
+        # 128 random bits as 22 URL-safe chars (shorter key than a hyphenated UUID)
+        session_id = secrets.token_urlsafe(16)
         
         # Generate title if not provided
         if not title:
@@ -25,12 +26,12 @@ class ChatbotOrchestrator:
             user_id=user_id,
             session_id=session_id,
             title=title,
-            is_active=True
+            is_active=True,
+            messages=[]  # Known empty, so serializing it doesn't trigger a lazy load
         )
         
         db.add(session)
         db.commit()
-        db.refresh(session)
         
         return session
     
@@ -41,65 +42,105 @@ class ChatbotOrchestrator:
             ChatSession.is_active == True
         ).first()
     
-    def get_user_sessions(self, db: Session, user_id: int) -> List[ChatSession]:
-        """Get all sessions for a user"""
-        return db.query(ChatSession).filter(
+    def get_session_for_user(self, db: Session, session_id: str, user_id: int,
+                             with_messages: bool = False) -> Optional[ChatSession]:
+        """Get an active session by session_id, only if it belongs to user_id"""
+        # Ownership is part of the WHERE clause, so a foreign session looks the same as a missing one
+        query = db.query(ChatSession).filter(
+            ChatSession.session_id == session_id,
             ChatSession.user_id == user_id,
             ChatSession.is_active == True
-        ).order_by(ChatSession.updated_at.desc()).all()
+        )
+        if with_messages:
+            query = query.options(selectinload(ChatSession.messages))
+        return query.first()
     
-    def save_message(self, db: Session, session_id: int, role: str, content: str, 
-                    tokens_used: int = None, tool_calls: Dict[str, Any] = None) -> ChatMessage:
-        """Save a message to the database"""
+    def get_session_messages_for_user(self, db: Session, session_id: str, user_id: int,
+                                      after: Optional[datetime] = None, limit: int = 20) -> List[ChatMessage]:
+        """Get a page of a user's session messages in one query joined on session ownership"""
+        query = db.query(ChatMessage).join(ChatSession, ChatMessage.session_id == ChatSession.id).filter(
+            ChatSession.session_id == session_id,
+            ChatSession.user_id == user_id,
+            ChatSession.is_active == True
+        )
+        if after:
+            query = query.filter(ChatMessage.created_at > after)
+        return query.order_by(ChatMessage.created_at.asc()).limit(limit).all()
+    
+    def deactivate_session_for_user(self, db: Session, session_id: str, user_id: int) -> bool:
+        """Soft-delete a user's active session in one UPDATE; False if there was none to delete"""
+        deleted = db.query(ChatSession).filter(
+            ChatSession.session_id == session_id,
+            ChatSession.user_id == user_id,
+            ChatSession.is_active == True
+        ).update({ChatSession.is_active: False}, synchronize_session=False)
+        db.commit()
+        return deleted > 0
+    
+    def get_user_sessions(self, db: Session, user_id: int, before: Optional[datetime] = None,
+                          limit: int = 20) -> List[ChatSession]:
+        """Get a page of sessions for a user, most recently active first"""
+        # Sessions that were never updated only have created_at
+        last_activity = func.coalesce(ChatSession.updated_at, ChatSession.created_at)
+        # The session schema includes messages; load them for the whole page in one
+        # extra IN query instead of one lazy load per session
+        query = db.query(ChatSession).options(selectinload(ChatSession.messages)).filter(
+            ChatSession.user_id == user_id,
+            ChatSession.is_active == True
+        )
+        if before:
+            query = query.filter(last_activity < before)
+        return query.order_by(last_activity.desc()).limit(limit).all()
+    
+    def _build_message(self, db: Session, session_id: int, role: str, content: str, 
+                       tokens_used: int = None, tool_calls: Dict[str, Any] = None) -> ChatMessage:
+        """Add a message to the session without committing"""
+        # Timestamped here rather than by the server default, since messages
+        # written in one transaction would otherwise share the same now()
         message = ChatMessage(
             session_id=session_id,
             role=role,
             content=content,
             tokens_used=tokens_used,
-            tool_calls=tool_calls
+            tool_calls=tool_calls,
+            created_at=datetime.now(timezone.utc)
         )
         
         db.add(message)
-        db.commit()
-        db.refresh(message)
-        
         return message
     
-    def get_conversation_history(self, db: Session, session_id: int, 
-                               limit: int = 20) -> List[ChatMessage]:
-        """Get conversation history for a session - returns actual ChatMessage objects"""
-        messages = db.query(ChatMessage).filter(
-            ChatMessage.session_id == session_id
-        ).order_by(ChatMessage.created_at.asc()).limit(limit).all()
+    def save_message(self, db: Session, session_id: int, role: str, content: str, 
+                    tokens_used: int = None, tool_calls: Dict[str, Any] = None) -> ChatMessage:
+        """Save a message to the database"""
+        message = self._build_message(db, session_id, role, content, tokens_used, tool_calls)
+        db.commit()
         
-        return messages
+        return message
     
     def get_conversation_history_for_llm(self, db: Session, session_id: int, 
                                        limit: int = 20) -> List[Dict[str, Any]]:
         """Get conversation history in format expected by LLM"""
-        messages = db.query(ChatMessage).filter(
+        # Latest `limit` messages, re-sorted chronologically in SQL. Only the needed
+        # columns are selected, so no ChatMessage objects are hydrated.
+        recent = select(ChatMessage.role, ChatMessage.content, ChatMessage.created_at).where(
             ChatMessage.session_id == session_id
-        ).order_by(ChatMessage.created_at.desc()).limit(limit).all()
+        ).order_by(ChatMessage.created_at.desc()).limit(limit).subquery()
+        rows = db.execute(
+            select(recent.c.role, recent.c.content).order_by(recent.c.created_at.asc())
+        ).all()
         
         # Convert to format expected by LLM
-        history = []
-        for msg in reversed(messages):  # Reverse to get chronological order
-            history.append({
-                "role": msg.role,
-                "content": msg.content
-            })
-        
-        return history
+        return [{"role": role, "content": content} for role, content in rows]
     
     def get_context(self, db: Session, session_id: str) -> Optional[Dict[str, Any]]:
         """Get conversation context for a session"""
-        context = db.query(ConversationContext).filter(
-            ConversationContext.session_id == session_id
-        ).first()
+        context_data = db.execute(
+            select(ConversationContext.context_data).where(
+                ConversationContext.session_id == session_id
+            )
+        ).scalar_one_or_none()
         
-        if context and context.context_data:
-            return context.context_data
-        return None
+        return context_data or None
     
     def save_context(self, db: Session, session_id: str, context_data: Dict[str, Any]):
         """Save conversation context"""
@@ -118,7 +159,6 @@ class ChatbotOrchestrator:
             db.add(context)
         
         db.commit()
-        db.refresh(context)
         return context
     
     def update_context(self, db: Session, session_id: str, 
@@ -135,81 +175,115 @@ class ChatbotOrchestrator:
         if context_data:
             self.save_context(db, session_id, context_data)
     
+    def _start_turn(self, db: Session, user_id: int, message: str, session_id: str = None):
+        """Resolve the session, stage the user message and load what the LLM needs"""
+        # Get or create session
+        session = None
+        if session_id:
+            session = self.get_session_for_user(db, session_id, user_id)
+        
+        if not session:
+            session = self.create_session(db, user_id)
+        
+        # Stage user message; everything for this turn is committed together in
+        # _finish_turn. The session doesn't autoflush, so the history excludes it.
+        user_message = self._build_message(db, session.id, "user", message)
+        
+        # Get conversation history for LLM
+        history = self.get_conversation_history_for_llm(db, session.id)
+        
+        # Get context
+        context = self.get_context(db, session.session_id)
+        
+        return session, user_message, history, context
+    
+    def _finish_turn(self, db: Session, session: ChatSession, user_message: ChatMessage,
+                     response: Dict[str, Any]) -> Dict[str, Any]:
+        """Stage the assistant message and commit the whole turn at once"""
+        assistant_message = self._build_message(
+            db, 
+            session.id, 
+            "assistant", 
+            response["message"],
+            tokens_used=response.get("tokens_used"),
+            tool_calls=response.get("tool_calls")
+        )
+        
+        # Bump the session's activity time. func.now() makes the database stamp it, like the
+        # column's onupdate default, so the sessions list ordering doesn't depend on any
+        # worker's clock; assigning it is still needed to get the row into the UPDATE
+        session.updated_at = func.now()
+        db.commit()
+        
+        return {
+            "message": response["message"],
+            "session_id": session.session_id,
+            "tokens_used": response.get("tokens_used"),
+            "tool_calls": response.get("tool_calls"),
+            "context": response.get("context"),
+            "user_message_created_at": user_message.created_at,
+            "assistant_message_created_at": assistant_message.created_at
+        }
+    
+    def _error_response(self, db: Session, session_id: Optional[str], error: Exception) -> Dict[str, Any]:
+        db.rollback()
+        # Log error and return fallback response
+        print(f"Error processing message: {str(error)}")
+        return {
+            "message": "I apologize, but I'm experiencing technical difficulties. Please try again later.",
+            "session_id": session_id or "error",
+            "error": str(error)
+        }
+    
     async def process_message(self, db: Session, user_id: int, message: str, 
                             session_id: str = None) -> Dict[str, Any]:
         """Process a user message and return AI response"""
         try:
-            # Get or create session
-            session = None
-            if session_id:
-                session = self.get_session(db, session_id)
-                if not session or session.user_id != user_id:
-                    session = None
-            
-            if not session:
-                session = self.create_session(db, user_id)
-                session_id = session.session_id
-            
-            # Save user message
-            user_message = self.save_message(db, session.id, "user", message)
-            
-            # Get conversation history for LLM
-            history = self.get_conversation_history_for_llm(db, session.id)
-            
-            # Get context
-            context = self.get_context(db, session_id)
+            session, user_message, history, context = self._start_turn(db, user_id, message, session_id)
+            session_id = session.session_id
             
             # Process with LLM
-            response = await llm_integration.process_message(
+            response = await get_llm_integration().process_message(
                 message=message,
                 conversation_history=history,
-                context=context,
-                tools=chatbot_tools.get_tools()
+                context=context
             )
             
-            # Save assistant message
-            assistant_message = self.save_message(
-                db, 
-                session.id, 
-                "assistant", 
-                response["message"],
-                tokens_used=response.get("tokens_used"),
-                tool_calls=response.get("tool_calls")
-            )
+            return self._finish_turn(db, session, user_message, response)
             
-            # Update session
-            session.updated_at = datetime.utcnow()
-            db.commit()
+        except Exception as e:
+            return self._error_response(db, session_id, e)
+    
+    async def stream_message(self, db: Session, user_id: int, message: str, 
+                           session_id: str = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Streaming variant of process_message: yields the LLM's delta/tool_calls events
+        as they arrive, then a final {"type": "done"} event with the saved turn
+        """
+        try:
+            session, user_message, history, context = self._start_turn(db, user_id, message, session_id)
+            session_id = session.session_id
             
-            return {
-                "message": response["message"],
-                "session_id": session_id,
-                "tokens_used": response.get("tokens_used"),
-                "tool_calls": response.get("tool_calls"),
-                "context": response.get("context"),
-                "user_message_created_at": user_message.created_at,
-                "assistant_message_created_at": assistant_message.created_at
-            }
+            async for event in get_llm_integration().stream_message(
+                message=message,
+                conversation_history=history,
+                context=context
+            ):
+                if event["type"] == "done":
+                    yield {"type": "done", **self._finish_turn(db, session, user_message, event)}
+                else:
+                    yield {**event, "session_id": session_id}
             
         except Exception as e:
-            # Log error and return fallback response
-            print(f"Error processing message: {str(e)}")
-            return {
-                "message": "I apologize, but I'm experiencing technical difficulties. Please try again later.",
-                "session_id": session_id or "error",
-                "error": str(e)
-            }
+            yield {"type": "done", **self._error_response(db, session_id, e)}
     
     def cleanup_expired_sessions(self, db: Session):
         """Clean up expired sessions"""
         cutoff_time = datetime.utcnow() - self.session_timeout
-        expired_sessions = db.query(ChatSession).filter(
+        db.query(ChatSession).filter(
             ChatSession.updated_at < cutoff_time,
             ChatSession.is_active == True
-        ).all()
-        
-        for session in expired_sessions:
-            session.is_active = False
+        ).update({ChatSession.is_active: False}, synchronize_session=False)
         
         db.commit()
 
@@ -1,119 +1,204 @@
 import os
 import uuid
-import aiofiles
-from typing import Optional
+from typing import Optional, Tuple
 from fastapi import UploadFile, HTTPException, status, Request
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 import io
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from functools import lru_cache
+
+@lru_cache(maxsize=1)
+def get_image_pool() -> ProcessPoolExecutor:
+    """
+    Process pool for image decoding/resizing, which is CPU-bound and so kept off the
+    event loop thread. Built on first upload, so workers that never see one don't start
+    any processes. Children are spawned rather than forked: the parent already runs the
+    revocation listener and token writer threads, and forking those risks deadlocks.
+    """
+    max_workers = int(os.getenv("IMAGE_PROCESS_WORKERS", "2"))
+    return ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+    )
+
+def shutdown_image_pool():
+    """Stop the image worker processes, if the pool was ever built"""
+    if get_image_pool.cache_info().currsize:
+        get_image_pool().shutdown()
+
+class ImageProcessingError(Exception):
+    """Raised by the image worker; carries the client-facing error detail"""
 
 class FileUploadManager:
     def __init__(self):
         self.upload_dir = "uploads"
         self.avatar_dir = os.path.join(self.upload_dir, "avatars")
         self.max_file_size = 5 * 1024 * 1024  # 5MB
+        self.read_chunk_size = 64 * 1024
         self.allowed_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.webp'}
         self.max_dimensions = (800, 800)  # Max width/height
+        # Avatars are normalized to WebP; animated GIFs are kept as uploaded
+        self.output_extension = '.webp'
+        self.webp_save_kwargs = {'quality': 82, 'method': 6}
+        self.invalid_image_message = "Invalid image file. Please upload a valid image."
+        # Public base URL for avatar links; when unset it's derived from each request
+        self.base_url = os.getenv("BASE_URL", "").rstrip('/') or None
         
         # Create upload directories if they don't exist
         os.makedirs(self.upload_dir, exist_ok=True)
         os.makedirs(self.avatar_dir, exist_ok=True)
     
-    def validate_file_type(self, file: UploadFile) -> bool:
-        """Validate if the uploaded file is an image based on extension"""
-        if not file.filename:
-            return False
-        
-        # Check file extension
-        file_extension = os.path.splitext(file.filename)[1].lower()
-        return file_extension in self.allowed_extensions
-    
     def validate_file_size(self, file_content: bytes) -> bool:
         """Validate file size"""
         return len(file_content) <= self.max_file_size
     
-    async def validate_image_content(self, file_content: bytes) -> bool:
-        """Validate image content by trying to open it with PIL"""
+    def is_already_optimized(self, image: Image.Image, file_content: bytes) -> bool:
+        """Check from the header alone whether the upload can be stored as-is"""
+        return (
+            image.format == 'WEBP'
+            and image.width <= self.max_dimensions[0]
+            and image.height <= self.max_dimensions[1]
+            and len(file_content) <= self.max_file_size
+            # re-encode to strip EXIF (e.g. GPS) and XMP metadata
+            and "exif" not in image.info
+            and "xmp" not in image.info
+        )
+    
+    def _decode_all_frames(self, image: Image.Image):
+        """Decode every frame's pixel data; raises OSError on truncated or corrupt data"""
+        for frame in range(getattr(image, 'n_frames', 1)):
+            image.seek(frame)
+            image.load()
+    
+    async def process_image(self, file_content: bytes) -> Tuple[bytes, str]:
+        """Validate, then process and optimize the image in the worker pool.
+        Returns the stored bytes and their file extension."""
+        loop = asyncio.get_running_loop()
         try:
-            # Try to open the image with PIL to validate it's a real image
-            image = Image.open(io.BytesIO(file_content))
-            image.verify()  # Verify the image
-            return True
-        except Exception:
-            return False
+            return await loop.run_in_executor(
+                get_image_pool(), self._process_image_sync, file_content
+            )
+        except ImageProcessingError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=str(e)
+            )
     
-    async def process_image(self, file_content: bytes, file_extension: str) -> bytes:
-        """Process and optimize the image"""
+    def _process_image_sync(self, file_content: bytes) -> Tuple[bytes, str]:
+        """Body of process_image; runs in a worker process"""
+        # Open image with PIL; this reads the header only and doubles as validation
         try:
-            # Open image with PIL
             image = Image.open(io.BytesIO(file_content))
+        except (UnidentifiedImageError, OSError):
+            raise ImageProcessingError(self.invalid_image_message)
+        
+        # Skip the decode/re-encode round-trip for avatars that are already fine
+        if self.is_already_optimized(image, file_content):
+            # Image.open only parsed the header; decode the pixels before storing the bytes
+            try:
+                self._decode_all_frames(image)
+            except (OSError, EOFError):
+                raise ImageProcessingError(self.invalid_image_message)
+            return file_content, self.output_extension
+        
+        # Re-encoding would keep only the first frame of an animation, so animations are
+        # stored as uploaded; that means they must already fit the size limits
+        if image.format == 'GIF' and getattr(image, 'is_animated', False):
+            if image.width > self.max_dimensions[0] or image.height > self.max_dimensions[1]:
+                raise ImageProcessingError(
+                    f"Animated GIFs can be at most {self.max_dimensions[0]}x{self.max_dimensions[1]} pixels."
+                )
+            try:
+                self._decode_all_frames(image)
+            except (OSError, EOFError):
+                raise ImageProcessingError(self.invalid_image_message)
+            return file_content, '.gif'
+        
+        try:
+            # Pillow resizes palette and bilevel images nearest-neighbour, so convert
+            # those first to keep LANCZOS quality
+            if image.mode in ('P', 'PA', '1'):
+                image = self._convert_for_webp(image)
             
-            # Convert to RGB if necessary (for JPEG compatibility)
-            if image.mode in ('RGBA', 'LA', 'P'):
-                image = image.convert('RGB')
-            
-            # Resize if image is too large
+            # Resize if image is too large. For other modes this runs before conversion
+            # so that thumbnail() can use JPEG draft mode (shrink-on-load) instead of
+            # first decoding the full-resolution pixel buffer.
             if image.width > self.max_dimensions[0] or image.height > self.max_dimensions[1]:
                 image.thumbnail(self.max_dimensions, Image.Resampling.LANCZOS)
             
-            # Determine output format based on original extension
-            if file_extension.lower() in ['.jpg', '.jpeg']:
-                output_format = 'JPEG'
-                save_kwargs = {'quality': 85, 'optimize': True}
-            elif file_extension.lower() == '.png':
-                output_format = 'PNG'
-                save_kwargs = {'optimize': True}
-            elif file_extension.lower() == '.gif':
-                output_format = 'GIF'
-                save_kwargs = {}
-            elif file_extension.lower() == '.webp':
-                output_format = 'WEBP'
-                save_kwargs = {'quality': 85}
-            else:
-                # Default to JPEG
-                output_format = 'JPEG'
-                save_kwargs = {'quality': 85, 'optimize': True}
+            if image.mode not in ('RGB', 'RGBA'):
+                image = self._convert_for_webp(image)
             
             # Save optimized image
             output = io.BytesIO()
-            image.save(output, format=output_format, **save_kwargs)
-            output.seek(0)
+            image.save(output, format='WEBP', **self.webp_save_kwargs)
             
-            return output.getvalue()
+            return output.getvalue(), self.output_extension
+        except OSError:
+            # Decode errors (truncated or corrupt data) surface here on the real decode
+            raise ImageProcessingError(self.invalid_image_message)
         except Exception as e:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Failed to process image: {str(e)}"
-            )
+            raise ImageProcessingError(f"Failed to process image: {str(e)}")
     
-    def generate_filename(self, original_filename: str) -> str:
-        """Generate unique filename for uploaded file"""
-        # Get file extension
-        file_extension = os.path.splitext(original_filename)[1].lower()
-        
+    def _convert_for_webp(self, image: Image.Image) -> Image.Image:
+        """WebP takes RGB or RGBA; keep an alpha channel only if there is one"""
+        has_alpha = image.mode in ('LA', 'PA') or 'transparency' in image.info
+        return image.convert('RGBA' if has_alpha else 'RGB')
+    
+    def generate_filename(self, file_extension: str) -> str:
+        """Generate unique filename for a stored file with the given extension"""
         # Generate unique filename
         unique_id = str(uuid.uuid4())
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         
         return f"avatar_{timestamp}_{unique_id}{file_extension}"
     
+    def _write_file_atomic(self, file_path: str, content: bytes):
+        """Write content to a temp file, then rename it into place so readers never
+        see a partial file. No fsync: a lost avatar on crash can be re-uploaded."""
+        tmp_path = f"{file_path}.tmp.{uuid.uuid4().hex}"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            try:
+                view = memoryview(content)
+                while view:
+                    view = view[os.write(fd, view):]
+            finally:
+                os.close(fd)
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            # Don't leave a partial temp file behind (e.g. ENOSPC mid-write)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+    
     async def save_avatar(self, file: UploadFile, user_id: int) -> str:
         """Save avatar file and return the relative file path"""
-        # Validate file type
-        if not self.validate_file_type(file):
+        # Validate file type by extension
+        file_extension = os.path.splitext(file.filename or "")[1].lower()
+        if file_extension not in self.allowed_extensions:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Invalid file type. Only JPG, PNG, GIF, and WebP images are allowed."
             )
         
-        # Read file content
+        # Read file content in chunks, stopping as soon as it exceeds the size limit
+        buffer = io.BytesIO()
         try:
-            file_content = await file.read()
+            while chunk := await file.read(self.read_chunk_size):
+                buffer.write(chunk)
+                if buffer.tell() > self.max_file_size:
+                    break
         except Exception as e:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail=f"Failed to read file: {str(e)}"
             )
+        file_content = buffer.getvalue()
         
         # Validate file size
         if not self.validate_file_size(file_content):
@@ -122,27 +207,16 @@ class FileUploadManager:
                 detail=f"File too large. Maximum size is {self.max_file_size // (1024*1024)}MB."
             )
         
-        # Validate image content by trying to open it
-        if not await self.validate_image_content(file_content):
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Invalid image file. Please upload a valid image."
-            )
-        
-        # Get file extension for processing
-        file_extension = os.path.splitext(file.filename)[1].lower()
-        
-        # Process and optimize image
-        processed_content = await self.process_image(file_content, file_extension)
+        # Validate, process and optimize image
+        processed_content, output_extension = await self.process_image(file_content)
         
         # Generate filename
-        filename = self.generate_filename(file.filename)
+        filename = self.generate_filename(output_extension)
         file_path = os.path.join(self.avatar_dir, filename)
         
         # Save file
         try:
-            async with aiofiles.open(file_path, 'wb') as f:
-                await f.write(processed_content)
+            await asyncio.to_thread(self._write_file_atomic, file_path, processed_content)
         except Exception as e:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -152,12 +226,20 @@ class FileUploadManager:
         # Return relative path for database storage (always relative)
         return f"/uploads/avatars/{filename}"
     
+    def _base_url(self, request: Request) -> str:
+        """BASE_URL if configured, otherwise the request's base URL (derived once per request)"""
+        if self.base_url:
+            return self.base_url
+        base_url = getattr(request.state, "base_url", None)
+        if base_url is None:
+            base_url = str(request.base_url).rstrip('/')
+            request.state.base_url = base_url
+        return base_url
+    
     def get_avatar_url(self, relative_path: str, request: Request) -> str:
-        """Convert relative path to full URL using request's base URL"""
+        """Convert relative path to full URL using the configured or request's base URL"""
         if relative_path and relative_path.startswith('/uploads/'):
-            # Use the request's base URL to construct the full URL
-            base_url = str(request.base_url).rstrip('/')
-            return f"{base_url}{relative_path}"
+            return f"{self._base_url(request)}{relative_path}"
         return relative_path
     
     def delete_avatar(self, relative_path: str) -> bool:
@@ -1,12 +1,28 @@
 import os
-import json
-from typing import Dict, Any, List, Optional
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Dict, Any, List, Optional, AsyncIterator
+import httpx
 import openai
-from dotenv import load_dotenv
+import orjson
+import tiktoken
 
 from tools import chatbot_tools
+from semantic_cache import SemanticResponseCache
 
-load_dotenv()
+CHAT_MODEL = "gpt-4o"  # Using GPT-4o for better performance
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str):
+    """Local tokenizer for a model; the first call may download its BPE file, so warm it at startup"""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
 
 class LLMIntegration:
     def __init__(self):
@@ -14,10 +30,45 @@ class LLMIntegration:
         if not self.api_key:
             raise ValueError("OPENAI_API_KEY environment variable is required")
         
-        self.client = openai.OpenAI(api_key=self.api_key)
-        self.model = "gpt-4o"  # Using GPT-4o for better performance
+        # Pooled keep-alive client, so follow-up calls reuse warm TLS connections
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=30.0),
+            timeout=httpx.Timeout(60.0, connect=5.0)
+        )
+        # The SDK retries 408/409/429/5xx and connection errors with exponential backoff
+        # and jitter (honouring Retry-After); auth and bad-request errors are not retried
+        self.client = openai.AsyncOpenAI(
+            api_key=self.api_key,
+            http_client=http_client,
+            max_retries=5,
+            timeout=60.0
+        )
+        # Cap in-flight OpenAI calls so bursts queue here instead of becoming a 429 storm
+        self._semaphore = asyncio.Semaphore(int(os.getenv("OPENAI_MAX_CONCURRENCY", "32")))
+        
+        self.model = CHAT_MODEL
+        # Composing a reply from tool output is light work; tool selection stays on self.model
+        self.followup_model = os.getenv("OPENAI_FOLLOWUP_MODEL", "gpt-4o-mini")
         self.max_tokens = 1000
-        self.temperature = 0.7
+        self.history_max_tokens = 8000
+        # Sampling temperature for chat replies. The response caches below only apply to
+        # low-temperature deployments: the semantic cache at or below
+        # semantic_cache_max_temperature, the exact-match cache at 0.
+        self.temperature = float(os.getenv("OPENAI_TEMPERATURE", "0.7"))
+        
+        # Local tokenizer for token counting (no API round-trip)
+        self._encoding = get_encoding(self.model)
+        
+        # Exact-match response cache for deterministic calls: key -> (stored_at, response)
+        self._response_cache: "OrderedDict[str, tuple]" = OrderedDict()
+        self._response_cache_ttl = 3600
+        self._response_cache_max = 1024
+        
+        # Semantic cache for near-duplicate prompts; sampling at higher temperatures is
+        # meant to vary, so it's only consulted for low-temperature calls
+        self.semantic_cache = SemanticResponseCache()
+        self.semantic_cache_max_temperature = float(os.getenv("SEMANTIC_CACHE_MAX_TEMPERATURE", "0.3"))
+        self.embedding_model = "text-embedding-3-small"
         
         self.system_prompt = """You are a helpful AI assistant with access to various tools. You can:
 - Perform calculations using the calculate tool
@@ -26,6 +77,149 @@ class LLMIntegration:
 - Get weather information using weather_search
 
 When a user asks a question that requires using tools, use the appropriate tool and then provide a helpful response based on the tool's output. Always be helpful and informative in your responses."""
+        self._system_message = {"role": "system", "content": self.system_prompt}
+        
+        # Tool schemas are sent on every turn; reusing one list keeps them byte-identical,
+        # which keeps them inside OpenAI's cached prompt prefix
+        self.tools = chatbot_tools.get_tools()
+        
+        # Both are fixed for the process, so hash them once; response-cache keys extend
+        # a copy of this hasher with only the per-request parts
+        self._prefix_hasher = hashlib.sha256(
+            orjson.dumps([self._system_message, self.tools], option=orjson.OPT_SORT_KEYS)
+        )
+
+    def _build_messages(
+        self,
+        message: str,
+        conversation_history: List[Dict[str, Any]] = None,
+        context: Dict[str, Any] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Build the chat payload. The system prompt stays an unchanged first message and
+        per-user context rides on the final user message, so the request prefix is
+        identical across calls and OpenAI's prompt cache can reuse it.
+        
+        conversation_history must already be in chat format ({"role", "content"} dicts,
+        as get_conversation_history_for_llm returns); it is trimmed to the newest
+        messages that fit history_max_tokens but otherwise used without copying.
+        """
+        # Add current user message, prefixed with context if available.
+        # Keys are sorted so identical contexts serialize identically.
+        if context:
+            message = f"[User context: {orjson.dumps(context, option=orjson.OPT_SORT_KEYS).decode()}]\n\n{message}"
+        
+        return [self._system_message, *self._trim_history(conversation_history), {"role": "user", "content": message}]
+
+    def _trim_history(
+        self,
+        conversation_history: List[Dict[str, Any]] = None,
+        max_tokens: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Keep the newest messages whose combined size fits the token budget. Tool calls
+        and tool results count too, since their JSON payloads are often the largest
+        part of a turn.
+        """
+        if not conversation_history:
+            return []
+        budget = self.history_max_tokens if max_tokens is None else max_tokens
+        
+        used = 0
+        start = len(conversation_history)
+        for index in range(len(conversation_history) - 1, -1, -1):
+            msg = conversation_history[index]
+            used += len(self._encoding.encode_ordinary(msg.get("content") or ""))
+            if msg.get("tool_calls"):
+                used += len(self._encoding.encode_ordinary(orjson.dumps(msg["tool_calls"]).decode()))
+            if used > budget:
+                break
+            start = index
+        
+        # Don't open the window on tool results whose assistant tool call was cut off
+        while start < len(conversation_history) and conversation_history[start]["role"] == "tool":
+            start += 1
+        return conversation_history[start:] if start else conversation_history
+
+    @asynccontextmanager
+    async def _openai_slot(self):
+        """Hold one of the process-wide OpenAI concurrency slots"""
+        started = time.monotonic()
+        async with self._semaphore:
+            waited = time.monotonic() - started
+            if waited > 1.0:
+                print(f"Waited {waited:.2f}s for an OpenAI concurrency slot")
+            yield
+
+    def _cache_key(self, params: Dict[str, Any]) -> str:
+        """
+        Hash of a completion request. The shared system message and tool list come
+        from the precomputed prefix hash; the flags record whether they were used.
+        """
+        messages = params["messages"]
+        shared_system = bool(messages) and messages[0] is self._system_message
+        shared_tools = params.get("tools") is self.tools
+        variable = {
+            **params,
+            "messages": messages[1:] if shared_system else messages,
+            "tools": None if shared_tools else params.get("tools"),
+            "_shared": (shared_system, shared_tools)
+        }
+        hasher = self._prefix_hasher.copy()
+        hasher.update(orjson.dumps(variable, option=orjson.OPT_SORT_KEYS, default=str))
+        return hasher.hexdigest()
+
+    async def _create_completion(self, use_cache: Optional[bool] = None, **params):
+        """
+        chat.completions.create with an exact-match LRU+TTL cache. Only deterministic
+        (temperature 0) requests are cached unless use_cache says otherwise.
+        """
+        if use_cache is None:
+            use_cache = params.get("temperature") == 0
+        if not use_cache:
+            async with self._openai_slot():
+                return await self.client.chat.completions.create(**params)
+        
+        key = self._cache_key(params)
+        now = time.monotonic()
+        cached = self._response_cache.get(key)
+        if cached and now - cached[0] < self._response_cache_ttl:
+            self._response_cache.move_to_end(key)
+            return cached[1]
+        
+        async with self._openai_slot():
+            response = await self.client.chat.completions.create(**params)
+        self._response_cache[key] = (now, response)
+        self._response_cache.move_to_end(key)
+        while len(self._response_cache) > self._response_cache_max:
+            self._response_cache.popitem(last=False)
+        return response
+
+    async def _embed(self, text: str) -> Optional[List[float]]:
+        """Embed text for the semantic cache; None if the embedding call fails"""
+        try:
+            async with self._openai_slot():
+                response = await self.client.embeddings.create(model=self.embedding_model, input=text)
+            return response.data[0].embedding
+        except openai.OpenAIError:
+            return None
+
+    def _conversation_chain_hash(
+        self,
+        conversation_history: List[Dict[str, Any]] = None,
+        context: Dict[str, Any] = None
+    ) -> str:
+        """Hash of what a cached answer depends on besides the message itself"""
+        previous_user_message = next(
+            (msg["content"] for msg in reversed(conversation_history or []) if msg["role"] == "user"), ""
+        )
+        return hashlib.sha256(
+            orjson.dumps([previous_user_message, context], option=orjson.OPT_SORT_KEYS, default=str)
+        ).hexdigest()
+
+    async def aclose(self):
+        """Close the pooled HTTP client (call on app shutdown)"""
+        await self.client.close()
 
     async def process_message(
         self, 
@@ -39,23 +233,16 @@ When a user asks a question that requires using tools, use the appropriate tool
         """
         try:
             # Prepare messages
-            messages = [{"role": "system", "content": self.system_prompt}]
-            
-            # Add conversation history
-            if conversation_history:
-                for msg in conversation_history:
-                    messages.append({
-                        "role": msg["role"],
-                        "content": msg["content"]
-                    })
-            
-            # Add context if available
-            if context:
-                context_message = f"User context: {json.dumps(context)}"
-                messages.append({"role": "system", "content": context_message})
+            messages = self._build_messages(message, conversation_history, context)
             
-            # Add current user message
-            messages.append({"role": "user", "content": message})
+            # Check the semantic cache for a near-duplicate of this turn
+            embedding = None
+            if self.temperature <= self.semantic_cache_max_temperature:
+                chain_hash = self._conversation_chain_hash(conversation_history, context)
+                embedding = await self._embed(message)
+                cached = self.semantic_cache.get(embedding, chain_hash) if embedding else None
+                if cached:
+                    return {**cached, "tokens_used": 0, "context": context}
             
             # Prepare API call parameters
             params = {
@@ -65,13 +252,15 @@ When a user asks a question that requires using tools, use the appropriate tool
                 "temperature": self.temperature
             }
             
-            # Add tools if provided
+            # Add tools (the shared tool list unless the caller passes its own)
+            if tools is None:
+                tools = self.tools
             if tools:
                 params["tools"] = tools
                 params["tool_choice"] = "auto"
             
             # Make initial API call
-            response = self.client.chat.completions.create(**params)
+            response = await self._create_completion(**params)
             assistant_message = response.choices[0].message
             tokens_used = response.usage.total_tokens if response.usage else None
             
@@ -90,30 +279,32 @@ When a user asks a question that requires using tools, use the appropriate tool
                     })
                 
                 # Execute tools and continue conversation
-                messages.append(assistant_message)
+                tool_messages = await self._execute_tool_calls(tool_calls)
                 
-                # Execute each tool call
-                for tool_call in assistant_message.tool_calls:
-                    tool_name = tool_call.function.name
-                    arguments = json.loads(tool_call.function.arguments)
-                    
-                    # Execute the tool
-                    tool_result = await chatbot_tools.execute_tool(tool_name, arguments)
-                    
-                    # Add tool result to messages
-                    messages.append({
-                        "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "content": tool_result
-                    })
+                # Structured tool output needs no rewording - skip the second model call
+                direct_reply = self._direct_reply(tool_calls, tool_messages)
+                if direct_reply is not None:
+                    # Keep any text the model sent along with the tool call
+                    if assistant_message.content:
+                        direct_reply = f"{assistant_message.content}\n\n{direct_reply}"
+                    return {
+                        "message": direct_reply,
+                        "tokens_used": tokens_used,
+                        "tool_calls": tool_calls,
+                        "context": context
+                    }
+                
+                messages.append({"role": "assistant", "content": assistant_message.content, "tool_calls": tool_calls})
+                messages.extend(tool_messages)
                 
                 # Make another API call to get final response
-                final_response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=messages,
-                    max_tokens=self.max_tokens,
-                    temperature=self.temperature
-                )
+                async with self._openai_slot():
+                    final_response = await self.client.chat.completions.create(
+                        model=self.followup_model,
+                        messages=messages,
+                        max_tokens=self.max_tokens,
+                        temperature=self.temperature
+                    )
                 
                 final_assistant_message = final_response.choices[0].message
                 final_tokens_used = final_response.usage.total_tokens if final_response.usage else None
@@ -125,6 +316,12 @@ When a user asks a question that requires using tools, use the appropriate tool
                     "context": context
                 }
             
+            # Only tool-free answers are cached; tool output (time, weather, search) goes stale
+            if embedding:
+                self.semantic_cache.add(
+                    embedding, chain_hash, {"message": assistant_message.content or "", "tool_calls": None}
+                )
+            
             return {
                 "message": assistant_message.content or "",
                 "tokens_used": tokens_used,
@@ -140,97 +337,164 @@ When a user asks a question that requires using tools, use the appropriate tool
                 "context": context
             }
     
-    def generate_response(
+    async def stream_message(
         self, 
-        user_message: str, 
+        message: str, 
         conversation_history: List[Dict[str, Any]] = None,
-        user_context: Dict[str, Any] = None,
+        context: Dict[str, Any] = None,
         tools: List[Dict[str, Any]] = None
-    ) -> Dict[str, Any]:
+    ) -> AsyncIterator[Dict[str, Any]]:
         """
-        Generate a response using OpenAI GPT-4 (legacy method)
+        Streaming variant of process_message. Yields {"type": "delta", "content"} events
+        as text arrives, {"type": "tool_calls"} once the model's tool calls have finished
+        streaming (tools then run immediately), and a final {"type": "done"} event with
+        the same fields process_message returns.
         """
+        tool_calls = None
+        tokens_used = None
+        content_parts: List[str] = []
         try:
             # Prepare messages
-            messages = [{"role": "system", "content": self.system_prompt}]
-            
-            # Add conversation history
-            if conversation_history:
-                for msg in conversation_history:
-                    messages.append({
-                        "role": msg["role"],
-                        "content": msg["content"]
-                    })
-            
-            # Add user context if available
-            if user_context:
-                context_message = f"User context: {json.dumps(user_context)}"
-                messages.append({"role": "system", "content": context_message})
-            
-            # Add current user message
-            messages.append({"role": "user", "content": user_message})
+            messages = self._build_messages(message, conversation_history, context)
             
             # Prepare API call parameters
             params = {
                 "model": self.model,
                 "messages": messages,
                 "max_tokens": self.max_tokens,
-                "temperature": self.temperature
+                "temperature": self.temperature,
+                "stream": True,
+                "stream_options": {"include_usage": True}
             }
             
-            # Add tools if provided
+            # Add tools (the shared tool list unless the caller passes its own)
+            if tools is None:
+                tools = self.tools
             if tools:
                 params["tools"] = tools
                 params["tool_choice"] = "auto"
             
-            # Make API call
-            response = self.client.chat.completions.create(**params)
-            
-            # Extract response
-            assistant_message = response.choices[0].message
-            tokens_used = response.usage.total_tokens if response.usage else None
+            # Stream the initial response, aggregating tool-call fragments by index
+            # (the concurrency slot is held while the stream is open)
+            partial_calls: Dict[int, Dict[str, Any]] = {}
+            async with self._openai_slot():
+                stream = await self.client.chat.completions.create(**params)
+                async for chunk in stream:
+                    if chunk.usage:
+                        tokens_used = chunk.usage.total_tokens
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta
+                    if delta.content:
+                        content_parts.append(delta.content)
+                        yield {"type": "delta", "content": delta.content}
+                    for fragment in delta.tool_calls or []:
+                        call = partial_calls.setdefault(fragment.index, {
+                            "id": None,
+                            "type": "function",
+                            "function": {"name": "", "arguments": ""}
+                        })
+                        if fragment.id:
+                            call["id"] = fragment.id
+                        if fragment.function:
+                            call["function"]["name"] += fragment.function.name or ""
+                            call["function"]["arguments"] += fragment.function.arguments or ""
             
             # Handle tool calls if any
-            tool_calls = None
-            if assistant_message.tool_calls:
-                tool_calls = []
-                for tool_call in assistant_message.tool_calls:
-                    tool_calls.append({
-                        "id": tool_call.id,
-                        "type": tool_call.type,
-                        "function": {
-                            "name": tool_call.function.name,
-                            "arguments": tool_call.function.arguments
-                        }
-                    })
+            if partial_calls:
+                tool_calls = [partial_calls[index] for index in sorted(partial_calls)]
+                yield {"type": "tool_calls", "tool_calls": tool_calls}
+                
+                # Execute tools and continue conversation
+                assistant_content = "".join(content_parts) or None
+                tool_messages = await self._execute_tool_calls(tool_calls)
+                content_parts = []
+                
+                # Structured tool output needs no rewording - skip the second model call
+                direct_reply = self._direct_reply(tool_calls, tool_messages)
+                if direct_reply is not None:
+                    # Text the model sent along with the tool call was already streamed; keep it
+                    if assistant_content:
+                        content_parts.append(assistant_content)
+                        direct_reply = f"\n\n{direct_reply}"
+                    content_parts.append(direct_reply)
+                    yield {"type": "delta", "content": direct_reply}
+                else:
+                    messages.append({"role": "assistant", "content": assistant_content, "tool_calls": tool_calls})
+                    messages.extend(tool_messages)
+                    
+                    # Stream the final response straight through
+                    async with self._openai_slot():
+                        stream = await self.client.chat.completions.create(
+                            model=self.followup_model,
+                            messages=messages,
+                            max_tokens=self.max_tokens,
+                            temperature=self.temperature,
+                            stream=True,
+                            stream_options={"include_usage": True}
+                        )
+                        async for chunk in stream:
+                            if chunk.usage:
+                                tokens_used = chunk.usage.total_tokens
+                            if chunk.choices and chunk.choices[0].delta.content:
+                                content_parts.append(chunk.choices[0].delta.content)
+                                yield {"type": "delta", "content": chunk.choices[0].delta.content}
             
-            return {
-                "content": assistant_message.content,
+            yield {
+                "type": "done",
+                "message": "".join(content_parts),
                 "tokens_used": tokens_used,
-                "tool_calls": tool_calls
+                "tool_calls": tool_calls,
+                "context": context
             }
             
         except Exception as e:
-            return {
-                "content": f"I apologize, but I encountered an error: {str(e)}",
+            yield {
+                "type": "done",
+                "message": f"I apologize, but I encountered an error: {str(e)}",
                 "tokens_used": None,
-                "tool_calls": None
+                "tool_calls": None,
+                "context": context
             }
     
-    def count_tokens(self, text: str) -> int:
+    async def _execute_tool_calls(self, tool_calls: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Execute tool calls concurrently and return the tool messages in call order"""
+        tool_results = await asyncio.gather(
+            *(
+                chatbot_tools.execute_tool(tool_call["function"]["name"], orjson.loads(tool_call["function"]["arguments"] or "{}"))
+                for tool_call in tool_calls
+            ),
+            return_exceptions=True
+        )
+        
+        tool_messages = []
+        for tool_call, tool_result in zip(tool_calls, tool_results):
+            if isinstance(tool_result, Exception):
+                tool_result = f"Error executing {tool_call['function']['name']}: {str(tool_result)}"
+            tool_messages.append({
+                "role": "tool",
+                "tool_call_id": tool_call["id"],
+                "content": tool_result
+            })
+        return tool_messages
+    
+    def _direct_reply(
+        self,
+        tool_calls: List[Dict[str, Any]],
+        tool_messages: List[Dict[str, Any]]
+    ) -> Optional[str]:
         """
-        Count tokens in a text string
+        The reply to send without a second model call, or None when any of the called
+        tools (e.g. web_search) needs the model to compose an answer from its output
         """
-        try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[{"role": "user", "content": text}],
-                max_tokens=1
-            )
-            return response.usage.prompt_tokens if response.usage else 0
-        except:
-            # Fallback: rough estimation (1 token ≈ 4 characters)
-            return len(text) // 4
+        if not all(call["function"]["name"] in chatbot_tools.direct_reply_tools for call in tool_calls):
+            return None
+        return "\n\n".join(tool_message["content"] for tool_message in tool_messages)
 
-# Initialize global LLM instance
-llm_integration = LLMIntegration() 
\ No newline at end of file
+@lru_cache(maxsize=1)
+def get_llm_integration() -> LLMIntegration:
+    """
+    Return the process-wide LLMIntegration, built on first use so importing this
+    module doesn't need OPENAI_API_KEY or open a connection pool
+    """
+    return LLMIntegration()
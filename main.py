@@ -1,14 +1,21 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Request, WebSocket, File, UploadFile
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi import FastAPI, Depends, HTTPException, status, Request, WebSocket, File, UploadFile, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from sqlalchemy.orm import Session
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy import exists, or_
+from sqlalchemy.orm import Session, load_only
 from datetime import timedelta, datetime
+import asyncio
 import os
-from typing import List
+import orjson
+from typing import List, Optional
+from dotenv import load_dotenv
 
-from database import get_db, engine
-from models import Base, User, Token
+# Load .env before importing the app modules that read their settings at import time
+load_dotenv()
+
+from database import get_db, engine, SessionLocal
+from models import Base, User
 from schemas import (
     UserCreate, UserLogin, UserUpdate, Token as TokenSchema, TokenRefresh, UserResponse,
     GoogleOAuthRequest, AvatarUploadResponse,
@@ -24,22 +31,31 @@ from auth import (
     save_token_to_db,
     revoke_token,
     revoke_user_tokens,
+    is_token_revoked,
+    load_revoked_tokens,
+    purge_expired_tokens,
     ACCESS_TOKEN_EXPIRE_MINUTES,
     REFRESH_TOKEN_EXPIRE_DAYS
 )
 from chatbot_orchestrator import chatbot_orchestrator
+from tools import chatbot_tools
+from revocation import token_revocation_store, RevocationError
+from token_writer import token_write_buffer
+from llm_integration import get_llm_integration, get_encoding, CHAT_MODEL
 from security import security_manager
 from websocket_chat import websocket_endpoint
-from file_upload import file_upload_manager
+from file_upload import file_upload_manager, shutdown_image_pool
 from google.oauth2 import id_token
 from google.auth.transport import requests as google_requests
-# Create database tables
-Base.metadata.create_all(bind=engine)
+# Schema is managed by Alembic; create_all is only for quick local setups that opt in
+if os.getenv("AUTO_CREATE_TABLES", "").lower() in ("1", "true", "yes"):
+    Base.metadata.create_all(bind=engine)
 
 app = FastAPI(
     title="AI Chatbot API",
     description="A complete AI chatbot system with authentication, LLM integration, and tools",
-    version="2.0.0"
+    version="2.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # Add CORS middleware
@@ -51,10 +67,62 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Google Sign-In: the client ID is fixed for the process, and one shared transport
+# keeps a pooled connection to Google's certificate endpoint between logins
+GOOGLE_CLIENT_ID = os.getenv("CLIENT_ID")
+google_auth_request = google_requests.Request()
+
 # Mount static files
 app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
 
-security = HTTPBearer()
+@app.on_event("startup")
+def rehydrate_revoked_tokens():
+    """Drop expired token rows, load revoked ones into the revocation store and listen for new ones"""
+    db = SessionLocal()
+    try:
+        # One worker per deploy is enough for the purge; the claim lapses before the next one
+        if token_revocation_store.claim("purge_expired_tokens", ttl=300):
+            purge_expired_tokens(db)
+        load_revoked_tokens(db)
+    finally:
+        db.close()
+    token_revocation_store.start_listener()
+
+@app.on_event("startup")
+def start_token_writer():
+    token_write_buffer.start()
+
+@app.on_event("startup")
+async def warm_tokenizer():
+    """Load (and on a cold cache, download) the tokenizer before the first chat request needs it"""
+    try:
+        await asyncio.to_thread(get_encoding, CHAT_MODEL)
+    except Exception as e:
+        print(f"Failed to preload tokenizer: {str(e)}")
+
+@app.on_event("shutdown")
+def stop_revocation_listener():
+    token_revocation_store.stop_listener()
+
+@app.on_event("shutdown")
+def stop_image_pool():
+    shutdown_image_pool()
+
+@app.on_event("shutdown")
+def flush_token_writer():
+    """Write out access tokens still queued for the database"""
+    token_write_buffer.stop()
+
+@app.on_event("shutdown")
+async def close_llm_client():
+    """Close the pooled OpenAI HTTP connections, if the client was ever built"""
+    if get_llm_integration.cache_info().currsize:
+        await get_llm_integration().aclose()
+
+@app.on_event("shutdown")
+async def close_tools_client():
+    """Close the HTTP connections shared by the chat tools"""
+    await chatbot_tools.aclose()
 
 @app.get("/")
 def read_root():
@@ -66,17 +134,16 @@ def signup(user: UserCreate, db: Session = Depends(get_db)):
     """
     Register a new user
     """
-    # Check if user already exists
-    db_user = db.query(User).filter(User.email == user.email).first()
-    if db_user:
+    # Check if the email or full_name is already taken, in one query
+    existing = db.query(User.email, User.full_name).filter(
+        or_(User.email == user.email, User.full_name == user.full_name)
+    ).all()
+    if any(row.email == user.email for row in existing):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Email already registered"
         )
-    
-    # Check if full_name already exists
-    db_user = db.query(User).filter(User.full_name == user.full_name).first()
-    if db_user:
+    if existing:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Full name already taken"
@@ -132,7 +199,7 @@ def login(
         )
     
     # Verify password
-    if not verify_password(user_credentials.password, user.hashed_password):
+    if not verify_password(user_credentials.password, user.hashed_password, db, user):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
@@ -149,13 +216,13 @@ def login(
     # Create access token
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
+        data={"sub": user.email, "ver": user.token_version}, expires_delta=access_token_expires
     )
     
     # Create refresh token
     refresh_token_expires = timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
     refresh_token = create_refresh_token(
-        data={"sub": user.email}, expires_delta=refresh_token_expires
+        data={"sub": user.email, "ver": user.token_version}, expires_delta=refresh_token_expires
     )
     
     # Save tokens to database
@@ -188,21 +255,17 @@ def refresh_token(token_data: TokenRefresh, db: Session = Depends(get_db)):
     Refresh access token using refresh token
     """
     # Verify refresh token
-    email = verify_refresh_token(token_data.refresh_token)
-    if email is None:
+    verified = verify_refresh_token(token_data.refresh_token)
+    if verified is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid refresh token",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    email, jti, _, token_version = verified
     
     # Check if refresh token is revoked
-    db_token = db.query(Token).filter(
-        Token.token == token_data.refresh_token,
-        Token.token_type == "refresh",
-        Token.is_revoked == True
-    ).first()
-    if db_token:
+    if is_token_revoked(db, jti):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Refresh token has been revoked",
@@ -217,21 +280,33 @@ def refresh_token(token_data: TokenRefresh, db: Session = Depends(get_db)):
             detail="User not found or inactive",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    if user.token_version != token_version:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Refresh token has been revoked",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
     
     # Create new access token
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     new_access_token = create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
+        data={"sub": user.email, "ver": user.token_version}, expires_delta=access_token_expires
     )
     
     # Create new refresh token
     refresh_token_expires = timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
     new_refresh_token = create_refresh_token(
-        data={"sub": user.email}, expires_delta=refresh_token_expires
+        data={"sub": user.email, "ver": user.token_version}, expires_delta=refresh_token_expires
     )
     
-    # Revoke old refresh token
-    revoke_token(db, token_data.refresh_token)
+    # Revoke old refresh token; if that can't be recorded, don't hand out new tokens either
+    try:
+        revoke_token(db, token_data.refresh_token)
+    except RevocationError:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Could not revoke the refresh token, please try again"
+        )
     
     # Save new tokens to database
     save_token_to_db(db, user.id, new_access_token, new_refresh_token)
@@ -244,17 +319,14 @@ def refresh_token(token_data: TokenRefresh, db: Session = Depends(get_db)):
 
 @app.post("/logout")
 def logout(
-    credentials: HTTPAuthorizationCredentials = Depends(security),
+    current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """
     Logout user by revoking all tokens
     """
-    token = credentials.credentials
-    user = get_current_active_user(credentials, db)
-    
     # Revoke all tokens for the user
-    revoked_tokens = revoke_user_tokens(db, user.id)
+    revoked_tokens = revoke_user_tokens(db, current_user.id)
     
     if revoked_tokens:
         return {"message": "Successfully logged out"}
@@ -300,11 +372,10 @@ def update_user_info(
     """
     # Check if full_name is being updated and if it's already taken
     if user_update.full_name and user_update.full_name != current_user.full_name:
-        existing_user = db.query(User).filter(
-            User.full_name == user_update.full_name,
-            User.id != current_user.id
-        ).first()
-        if existing_user:
+        name_taken = db.query(
+            exists().where(User.full_name == user_update.full_name, User.id != current_user.id)
+        ).scalar()
+        if name_taken:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Full name already taken"
@@ -317,9 +388,6 @@ def update_user_info(
     if user_update.avatar_url is not None:
         current_user.avatar_url = user_update.avatar_url
     
-    # Update the updated_at timestamp
-    current_user.updated_at = datetime.utcnow()
-    
     # Save changes to database
     db.commit()
     db.refresh(current_user)
@@ -360,7 +428,6 @@ async def upload_avatar(
         
         # Store only the relative path in database
         current_user.avatar_url = relative_path
-        current_user.updated_at = datetime.utcnow()
         db.commit()
         db.refresh(current_user)
         
@@ -382,15 +449,9 @@ async def upload_avatar(
         )
 
 # Chatbot endpoints
-@app.post("/chat", response_model=ChatResponse)
-async def chat_with_bot(
-    request: ChatRequest,
-    current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db),
-    client_request: Request = None
-):
+def check_chat_request(request: ChatRequest, current_user: User, client_request: Request) -> str:
     """
-    Send a message to the AI chatbot
+    Run the security checks shared by the chat endpoints and return the sanitized message
     """
     # Security checks
     client_ip = client_request.client.host if client_request else None
@@ -402,34 +463,30 @@ async def chat_with_bot(
             detail="Access denied due to suspicious activity"
         )
     
-    # Validate message
-    if not security_manager.validate_message(request.message):
+    # Validate message; a valid message needs no further sanitizing
+    sanitized_message = security_manager.clean_message(request.message)
+    if sanitized_message is None:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid message content or length"
         )
     
-    # Check rate limit
-    if not security_manager.check_rate_limit(current_user.id, client_ip):
+    # Check rate limit and record the request
+    if not security_manager.check_and_record_request(current_user.id, client_ip):
         raise HTTPException(
             status_code=status.HTTP_429_TOO_MANY_REQUESTS,
             detail="Rate limit exceeded. Please try again later."
         )
     
     # Detect suspicious activity
-    if security_manager.detect_suspicious_activity(request.message, current_user.id, client_ip):
+    if security_manager.detect_suspicious_activity(
+        sanitized_message, current_user.id, client_ip, message_cleaned=True
+    ):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Suspicious activity detected"
         )
     
-    # Record request
-    security_manager.record_request(current_user.id, client_ip)
-    
-    # Sanitize input
-    sanitized_message = security_manager.sanitize_input(request.message)
-    sanitized_context = security_manager.sanitize_context(request.context or {})
-    
     # Validate session ID if provided
     if request.session_id and not security_manager.validate_session(request.session_id):
         raise HTTPException(
@@ -437,6 +494,21 @@ async def chat_with_bot(
             detail="Invalid session ID format"
         )
     
+    return sanitized_message
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat_with_bot(
+    request: ChatRequest,
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db),
+    client_request: Request = None
+):
+    """
+    Send a message to the AI chatbot
+    """
+    # The checks may make Redis round-trips, so keep them off the event loop
+    sanitized_message = await asyncio.to_thread(check_chat_request, request, current_user, client_request)
+    
     # Process message
     try:
         response = await chatbot_orchestrator.process_message(
@@ -462,15 +534,47 @@ async def chat_with_bot(
             detail=f"Error processing message: {str(e)}"
         )
 
+@app.post("/chat/stream")
+async def chat_with_bot_stream(
+    request: ChatRequest,
+    current_user: User = Depends(get_current_active_user),
+    client_request: Request = None
+):
+    """
+    Send a message to the AI chatbot and stream the reply as server-sent events
+    """
+    # The checks may make Redis round-trips, so keep them off the event loop
+    sanitized_message = await asyncio.to_thread(check_chat_request, request, current_user, client_request)
+    user_id = current_user.id
+    
+    async def event_stream():
+        # The stream outlives the request's dependencies, so it owns its DB session
+        db = SessionLocal()
+        try:
+            async for event in chatbot_orchestrator.stream_message(
+                db=db,
+                user_id=user_id,
+                message=sanitized_message,
+                session_id=request.session_id
+            ):
+                yield f"data: {orjson.dumps(event, default=str).decode()}\n\n"
+        finally:
+            db.close()
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
 @app.get("/chat/sessions", response_model=List[ChatSessionSchema])
 def get_user_sessions(
+    before: Optional[datetime] = None,
+    limit: int = Query(20, ge=1, le=100),
     current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """
-    Get all chat sessions for the current user
+    Get chat sessions for the current user, most recent first.
+    Pass the last session's updated_at (or created_at) as `before` for the next page.
     """
-    sessions = chatbot_orchestrator.get_user_sessions(db, current_user.id)
+    sessions = chatbot_orchestrator.get_user_sessions(db, current_user.id, before=before, limit=limit)
     return sessions
 
 @app.get("/chat/sessions/{session_id}", response_model=ChatSessionSchema)
@@ -488,29 +592,26 @@ def get_session(
             detail="Invalid session ID format"
         )
     
-    session = chatbot_orchestrator.get_session(db, session_id)
+    session = chatbot_orchestrator.get_session_for_user(db, session_id, current_user.id, with_messages=True)
     if not session:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Session not found"
         )
     
-    if session.user_id != current_user.id:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Access denied"
-        )
-    
     return session
 
 @app.get("/chat/sessions/{session_id}/messages", response_model=List[ChatMessageSchema])
 def get_session_messages(
     session_id: str,
+    after: Optional[datetime] = None,
+    limit: int = Query(20, ge=1, le=100),
     current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """
-    Get all messages for a specific chat session
+    Get messages for a specific chat session in chronological order.
+    Pass the last message's created_at as `after` for the next page.
     """
     if not security_manager.validate_session(session_id):
         raise HTTPException(
@@ -518,20 +619,15 @@ def get_session_messages(
             detail="Invalid session ID format"
         )
     
-    session = chatbot_orchestrator.get_session(db, session_id)
-    if not session:
+    messages = chatbot_orchestrator.get_session_messages_for_user(
+        db, session_id, current_user.id, after=after, limit=limit
+    )
+    # An empty page is also what a missing or foreign session returns; only then check which
+    if not messages and not chatbot_orchestrator.get_session_for_user(db, session_id, current_user.id):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Session not found"
         )
-    
-    if session.user_id != current_user.id:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Access denied"
-        )
-    
-    messages = chatbot_orchestrator.get_conversation_history(db, session.id)
     return messages
 
 @app.post("/chat/sessions", response_model=ChatSessionSchema)
@@ -562,22 +658,12 @@ def delete_chat_session(
             detail="Invalid session ID format"
         )
     
-    session = chatbot_orchestrator.get_session(db, session_id)
-    if not session:
+    if not chatbot_orchestrator.deactivate_session_for_user(db, session_id, current_user.id):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Session not found"
         )
     
-    if session.user_id != current_user.id:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Access denied"
-        )
-    
-    session.is_active = False
-    db.commit()
-    
     return {"message": "Session deleted successfully"}
 
 @app.get("/admin/security/stats")
@@ -605,22 +691,27 @@ async def websocket_chat(
     await websocket_endpoint(websocket, token, session_id)
 
 @app.post("/auth/google/token")
-async def google_token_login(payload: dict, db: Session = Depends(get_db)):
+def google_token_login(payload: dict, db: Session = Depends(get_db)):
     token = payload.get("token")
     if not token:
         raise HTTPException(status_code=400, detail="Missing token")
-    GOOGLE_CLIENT_ID = os.getenv("CLIENT_ID")
     try:
-        idinfo = id_token.verify_oauth2_token(token, google_requests.Request(), GOOGLE_CLIENT_ID)
+        idinfo = id_token.verify_oauth2_token(token, google_auth_request, GOOGLE_CLIENT_ID)
         # Grab relevant fields
         email = idinfo["email"]
         full_name = idinfo.get("name")
         google_id = idinfo.get("sub")
         avatar_url = idinfo.get("picture")
         # Find or create user
-        user = db.query(User).filter(User.google_id == google_id).first()
-        if not user:
-            user = db.query(User).filter(User.email == email).first()
+        # One query for both the google_id and the email match; prefer the google_id match
+        # Only the columns this endpoint reads or writes
+        matches = db.query(User).options(load_only(
+            User.id, User.email, User.full_name, User.google_id,
+            User.avatar_url, User.auth_provider, User.token_version
+        )).filter(
+            or_(User.google_id == google_id, User.email == email)
+        ).limit(2).all()
+        user = next((u for u in matches if u.google_id == google_id), matches[0] if matches else None)
         if not user:
             user = User(
                 email=email,
@@ -633,20 +724,18 @@ async def google_token_login(payload: dict, db: Session = Depends(get_db)):
             db.add(user)
             db.commit()
             db.refresh(user)
-        else:
-            # Update user data
+        elif user.google_id != google_id or user.avatar_url != avatar_url:
+            # Update user data; a repeat login with unchanged data writes nothing
             user.google_id = google_id
             user.avatar_url = avatar_url
             db.commit()
         # Create JWT
         token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
         jwt_token = create_access_token(
-            data={"sub": user.email}, expires_delta=token_expires
+            data={"sub": user.email, "ver": user.token_version}, expires_delta=token_expires
         )
-        # Store token in DB
-        token_obj = Token(user_id=user.id, token=jwt_token, token_type="access")
-        db.add(token_obj)
-        db.commit()
+        # Queue the token row for a batched write; the row only matters for revocation
+        token_write_buffer.enqueue(user.id, jwt_token)
         return {
             "access_token": jwt_token,
             "user": {
@@ -665,5 +754,6 @@ async def google_token_login(payload: dict, db: Session = Depends(get_db)):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Protocol-level WebSocket pings keep idle chat connections alive and drop dead ones
+    uvicorn.run(app, host="0.0.0.0", port=8000, ws_ping_interval=20.0, ws_ping_timeout=20.0)
 
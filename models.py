@@ -1,5 +1,6 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text, ForeignKey, JSON
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text, ForeignKey, JSON, Index, text
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 
@@ -21,6 +22,8 @@ class User(Base):
     google_id = Column(String(255), unique=True, index=True, nullable=True)
     avatar_url = Column(String(500), nullable=True)
     auth_provider = Column(String(50), default="email")  # "email" or "google"
+    # Embedded in issued JWTs as "ver"; bumping it invalidates all of the user's tokens
+    token_version = Column(Integer, default=0, server_default="0", nullable=False)
     # Relationships
     chat_sessions = relationship("ChatSession", back_populates="user", cascade="all, delete-orphan")
 
@@ -30,10 +33,15 @@ class Token(Base):
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, nullable=False)
-    token = Column(Text, unique=True, index=True, nullable=False)
+    jti = Column(UUID(as_uuid=True), unique=True, index=True, nullable=False)  # JWT ID, not the raw token
     token_type = Column(String(50), default="access")  # "access" or "refresh"
     is_revoked = Column(Boolean, default=False)
+    expires_at = Column(DateTime(timezone=True), index=True, nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    __table_args__ = (
+        Index("ix_tokens_user_active", "user_id", "is_revoked", postgresql_where=text("is_revoked = false")),
+    )
 
 
 class ChatSession(Base):
@@ -50,6 +58,9 @@ class ChatSession(Base):
     # Relationships
     user = relationship("User", back_populates="chat_sessions")
     messages = relationship("ChatMessage", back_populates="session", cascade="all, delete-orphan")
+    
+    # Fetch server defaults (created_at) via INSERT ... RETURNING instead of a refresh
+    __mapper_args__ = {"eager_defaults": True}
 
 
 class ChatMessage(Base):
@@ -65,6 +76,11 @@ class ChatMessage(Base):
     
     # Relationships
     session = relationship("ChatSession", back_populates="messages")
+    
+    __table_args__ = (
+        Index("ix_chat_messages_session_created", "session_id", "created_at"),
+    )
+    __mapper_args__ = {"eager_defaults": True}
 
 
 class ConversationContext(Base):
@@ -74,4 +90,6 @@ class ConversationContext(Base):
     session_id = Column(String(255), unique=True, index=True, nullable=False)
     context_data = Column(JSON, nullable=True)  # Store conversation context as JSON
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    updated_at = Column(DateTime(timezone=True), onupdate=func.now()) 
\ No newline at end of file
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    
+    __mapper_args__ = {"eager_defaults": True}
\ No newline at end of file
@@ -0,0 +1,136 @@
+import os
+import threading
+import time
+from typing import Optional, Iterable, Tuple
+import redis
+from cachetools import TTLCache
+
+class RevocationError(Exception):
+    """A revocation could not be recorded in Redis, so other workers may still accept the token"""
+
+class TokenRevocationStore:
+    """
+    Redis-backed set of revoked token IDs (jti), with the database as the durable copy.
+    
+    Lookups are also remembered in-process: revoked results for an hour, "not revoked"
+    results for two minutes. Revocations are published on a Redis channel so other
+    workers drop their cached "not revoked" answers immediately.
+    """
+
+    def __init__(self):
+        self.key_prefix = "rev:"
+        self.channel = "token_revoked"
+        redis_url = os.getenv("REDIS_URL")
+        self.client = redis.Redis.from_url(redis_url) if redis_url else None
+        self._listener = None
+        
+        self._revoked = TTLCache(maxsize=50_000, ttl=3600)
+        self._not_revoked = TTLCache(maxsize=50_000, ttl=120)
+        self._local_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.client is not None
+
+    def is_revoked(self, jti: str) -> Optional[bool]:
+        """Return whether jti is revoked, or None if neither the local cache nor Redis can answer"""
+        with self._local_lock:
+            if jti in self._revoked:
+                return True
+            if jti in self._not_revoked:
+                return False
+        if not self.client:
+            return None
+        try:
+            revoked = bool(self.client.exists(f"{self.key_prefix}{jti}"))
+        except redis.RedisError:
+            return None
+        self.remember(jti, revoked)
+        return revoked
+
+    def remember(self, jti: str, revoked: bool):
+        """Cache a revocation answer in this process (e.g. one read from the database)"""
+        with self._local_lock:
+            if revoked:
+                self._not_revoked.pop(jti, None)
+                self._revoked[jti] = True
+            else:
+                self._not_revoked[jti] = True
+
+    def _on_revoked_message(self, message):
+        jti = message["data"]
+        self.remember(jti.decode() if isinstance(jti, bytes) else jti, True)
+
+    def start_listener(self):
+        """Subscribe to revocations published by other workers (call once per process)"""
+        if not self.client or self._listener:
+            return
+        try:
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.channel: self._on_revoked_message})
+            self._listener = pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+        except redis.RedisError as e:
+            print(f"Failed to subscribe to token revocations: {str(e)}")
+
+    def stop_listener(self):
+        if self._listener:
+            self._listener.stop()
+            self._listener = None
+
+    def revoke(self, jti: str, exp: Optional[int]):
+        """Mark jti as revoked until the token would have expired anyway"""
+        self.revoke_many([(jti, exp)])
+
+    def claim(self, name: str, ttl: Optional[int] = None) -> bool:
+        """
+        Claim a once-only job across workers with SET NX; returns True for the one worker
+        that should run it. Without Redis there is nothing to coordinate, so always True.
+        """
+        if not self.client:
+            return True
+        try:
+            return bool(self.client.set(f"once:{name}", 1, nx=True, ex=ttl))
+        except redis.RedisError as e:
+            print(f"Failed to claim {name}: {str(e)}")
+            return False
+
+    def release(self, name: str):
+        """Give up a claim so another worker (or the next start) can retry the job"""
+        if not self.client:
+            return
+        try:
+            self.client.delete(f"once:{name}")
+        except redis.RedisError:
+            pass
+
+    def revoke_many(self, entries: Iterable[Tuple[str, Optional[int]]], publish: bool = True):
+        """
+        Mark several (jti, exp) pairs as revoked in one round-trip. With publish=False the
+        keys are only written to Redis (used when rehydrating from the database, where no
+        worker can have a stale "not revoked" answer cached yet).
+
+        Raises RevocationError if Redis rejects the writes: other workers answer from
+        Redis without the database, so a revocation Redis never saw is not in effect.
+        """
+        entries = [(jti, exp) for jti, exp in entries if jti]
+        if self.client:
+            now = int(time.time())
+            try:
+                # MULTI/EXEC, so a key is never set without its publish or vice versa
+                pipe = self.client.pipeline(transaction=True)
+                for jti, exp in entries:
+                    ttl = exp - now if exp else None
+                    if ttl is not None and ttl <= 0:
+                        continue
+                    pipe.set(f"{self.key_prefix}{jti}", 1, ex=ttl)
+                    if publish:
+                        pipe.publish(self.channel, jti)
+                pipe.execute()
+            except redis.RedisError as e:
+                raise RevocationError(f"Failed to record token revocation in Redis: {str(e)}") from e
+        if publish:
+            for jti, _ in entries:
+                self.remember(jti, True)
+
+# Initialize global revocation store
+token_revocation_store = TokenRevocationStore()
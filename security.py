@@ -1,10 +1,38 @@
+import os
 import re
 import time
+import threading
 from typing import Dict, Any, Optional
 from fastapi import HTTPException, status
 from datetime import datetime, timedelta
-from collections import defaultdict
-import html
+from collections import Counter, defaultdict, deque
+import redis
+from cachetools import TTLCache
+
+# Characters HTML escaping would rewrite, and runs of whitespace or non-space whitespace
+_UNSAFE_TEXT_PATTERN = r'[<>&"\']|\s{2,}|[^\S ]'
+
+# token_urlsafe(16) format, or UUID format for sessions created before it
+_SESSION_ID_RE = re.compile(
+    r'(?:[A-Za-z0-9_-]{22}|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})'
+)
+
+# Sliding-window check-and-record over sorted sets, atomic across both keys.
+# KEYS: user key, ip key (optional). ARGV: now, cutoff, window, user limit, ip limit, member.
+_RATE_LIMIT_SCRIPT = """
+local limits = {tonumber(ARGV[4]), tonumber(ARGV[5])}
+for i, key in ipairs(KEYS) do
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', ARGV[2])
+    if redis.call('ZCARD', key) >= limits[i] then
+        return 0
+    end
+end
+for _, key in ipairs(KEYS) do
+    redis.call('ZADD', key, ARGV[1], ARGV[6])
+    redis.call('EXPIRE', key, ARGV[3])
+end
+return 1
+"""
 
 class SecurityManager:
     def __init__(self):
@@ -29,60 +57,47 @@ class SecurityManager:
             r'<title.*?>',
             r'<base.*?>',
             r'<bgsound.*?>',
-            r'<link.*?>',
-            r'<meta.*?>',
-            r'<style.*?>',
-            r'<title.*?>',
-            r'<base.*?>',
-            r'<bgsound.*?>',
-            r'<link.*?>',
-            r'<meta.*?>',
-            r'<style.*?>',
-            r'<title.*?>',
-            r'<base.*?>',
-            r'<bgsound.*?>',
         ]
+        # One alternation, compiled once. Named groups tell which pattern matched.
+        self._suspicious_re = re.compile(
+            '|'.join(f'(?P<p{i}>{pattern})' for i, pattern in enumerate(self.suspicious_patterns)),
+            re.IGNORECASE
+        )
+        # Everything clean_message rejects (markup, suspicious patterns, odd whitespace), as one scan
+        self._unclean_re = re.compile(
+            f'{_UNSAFE_TEXT_PATTERN}|{self._suspicious_re.pattern}', re.IGNORECASE
+        )
         
-        # Rate limiting storage (in production, use Redis)
-        self.request_counts = defaultdict(list)
+        self.ip_block_duration = 86400  # 1 day
+        
+        # Rate limits and IP blocks are shared through Redis when REDIS_URL is set, so
+        # every worker enforces the same limit; otherwise they live in this process only
+        redis_url = os.getenv("REDIS_URL")
+        self.redis = redis.Redis.from_url(redis_url) if redis_url else None
+        self._rate_limit_script = self.redis.register_script(_RATE_LIMIT_SCRIPT) if self.redis else None
+        
+        # Per-key request timestamps, oldest first, so expiry is a popleft from the head.
+        # Kept even with Redis for the per-worker burst check in detect_suspicious_activity.
+        self.request_counts = defaultdict(deque)
         self.blocked_ips = set()
         self.suspicious_ips = defaultdict(int)
+        # Short-lived answers to "is this IP blocked in Redis?" to absorb bursts
+        self._blocked_cache = TTLCache(maxsize=10_000, ttl=1)
+        self._blocked_cache_lock = threading.Lock()
     
-    def sanitize_input(self, text: str) -> str:
-        """Sanitize user input to prevent XSS and injection attacks"""
-        if not text:
-            return ""
-        
-        # Remove HTML tags
-        text = re.sub(r'<[^>]+>', '', text)
+    def clean_message(self, message: str) -> Optional[str]:
+        """
+        Validate a message in one pass and return it ready to use (stripped), or None
+        if it's empty, too long, or contains markup, suspicious patterns or odd whitespace
+        """
+        if not message or len(message) > self.max_message_length:
+            return None
         
-        # Escape HTML entities
-        text = html.escape(text)
+        stripped = message.strip()
+        if not stripped or self._unclean_re.search(stripped):
+            return None
         
-        # Remove suspicious patterns
-        for pattern in self.suspicious_patterns:
-            text = re.sub(pattern, '', text, flags=re.IGNORECASE)
-        
-        # Remove excessive whitespace
-        text = re.sub(r'\s+', ' ', text).strip()
-        
-        return text
-    
-    def validate_message(self, message: str) -> bool:
-        """Validate message content and length"""
-        if not message or not message.strip():
-            return False
-        
-        if len(message) > self.max_message_length:
-            return False
-        
-        # Check for suspicious content - compare sanitized with stripped original
-        sanitized = self.sanitize_input(message)
-        stripped_original = message.strip()
-        if sanitized != stripped_original:
-            return False
-        
-        return True
+        return stripped
     
     def check_rate_limit(self, user_id: int, ip_address: str = None) -> bool:
         """Check if user has exceeded rate limit"""
@@ -92,24 +107,63 @@ class SecurityManager:
         cutoff_time = current_time - self.rate_limit_window
         
         # Check user-based rate limiting
-        user_requests = self.request_counts[f"user_{user_id}"]
-        user_requests = [req for req in user_requests if req > cutoff_time]
-        self.request_counts[f"user_{user_id}"] = user_requests
+        user_requests = self._prune_requests(f"user_{user_id}", cutoff_time)
         
         if len(user_requests) >= self.max_requests_per_hour:
             return False
         
         # Check IP-based rate limiting (if IP provided)
         if ip_address:
-            ip_requests = self.request_counts[f"ip_{ip_address}"]
-            ip_requests = [req for req in ip_requests if req > cutoff_time]
-            self.request_counts[f"ip_{ip_address}"] = ip_requests
+            ip_requests = self._prune_requests(f"ip_{ip_address}", cutoff_time)
             
             if len(ip_requests) >= self.max_requests_per_hour * 2:  # Higher limit for IP
                 return False
         
         return True
     
+    def check_and_record_request(self, user_id: int, ip_address: str = None) -> bool:
+        """
+        Check the rate limits and record the request in one step. Returns False, without
+        recording, if the user or IP is over its limit. Uses Redis when configured,
+        falling back to this process's counters if Redis is unavailable.
+        """
+        current_time = time.time()
+        
+        if self._rate_limit_script:
+            keys = [f"rl:user_{user_id}"]
+            if ip_address:
+                keys.append(f"rl:ip_{ip_address}")
+            try:
+                allowed = bool(self._rate_limit_script(
+                    keys=keys,
+                    args=[
+                        current_time,
+                        current_time - self.rate_limit_window,
+                        self.rate_limit_window,
+                        self.max_requests_per_hour,
+                        self.max_requests_per_hour * 2,  # Higher limit for IP
+                        f"{current_time}:{os.getpid()}:{threading.get_ident()}",
+                    ],
+                ))
+            except redis.RedisError as e:
+                print(f"Redis rate limit check failed, using local counters: {str(e)}")
+            else:
+                if allowed:
+                    self.record_request(user_id, ip_address)
+                return allowed
+        
+        if not self.check_rate_limit(user_id, ip_address):
+            return False
+        self.record_request(user_id, ip_address)
+        return True
+    
+    def _prune_requests(self, key: str, cutoff_time: float) -> deque:
+        """Drop a key's timestamps at or before cutoff_time and return what's left"""
+        requests = self.request_counts[key]
+        while requests and requests[0] <= cutoff_time:
+            requests.popleft()
+        return requests
+    
     def record_request(self, user_id: int, ip_address: str = None):
         """Record a request for rate limiting"""
         current_time = time.time()
@@ -119,32 +173,36 @@ class SecurityManager:
         if ip_address:
             self.request_counts[f"ip_{ip_address}"].append(current_time)
     
-    def detect_suspicious_activity(self, message: str, user_id: int, ip_address: str = None) -> bool:
-        """Detect potentially suspicious activity"""
+    def detect_suspicious_activity(self, message: str, user_id: int, ip_address: str = None,
+                                   message_cleaned: bool = False) -> bool:
+        """
+        Detect potentially suspicious activity. Pass message_cleaned=True for a message
+        that passed clean_message, which already guarantees no suspicious pattern matches.
+        """
         suspicious_score = 0
         
-        # Check for suspicious patterns in message
-        for pattern in self.suspicious_patterns:
-            if re.search(pattern, message, re.IGNORECASE):
-                suspicious_score += 10
+        # Check for suspicious patterns in message (one scan; 10 points per distinct pattern)
+        if not message_cleaned:
+            matched = {match.lastgroup for match in self._suspicious_re.finditer(message)}
+            suspicious_score += 10 * len(matched)
         
         # Check for excessive repetition
         words = message.lower().split()
         if len(words) > 10:
-            word_counts = {}
-            for word in words:
-                word_counts[word] = word_counts.get(word, 0) + 1
-            
-            max_repetition = max(word_counts.values()) if word_counts else 0
+            max_repetition = Counter(words).most_common(1)[0][1]
             if max_repetition > len(words) * 0.3:  # More than 30% repetition
                 suspicious_score += 5
         
         # Check for rapid requests
         current_time = time.time()
-        user_requests = self.request_counts[f"user_{user_id}"]
-        recent_requests = [req for req in user_requests if req > current_time - 60]  # Last minute
+        # Count back from the newest; only need to know whether there are more than 10
+        recent_requests = 0
+        for req in reversed(self.request_counts[f"user_{user_id}"]):
+            if req <= current_time - 60 or recent_requests > 10:  # Last minute
+                break
+            recent_requests += 1
         
-        if len(recent_requests) > 10:  # More than 10 requests per minute
+        if recent_requests > 10:  # More than 10 requests per minute
             suspicious_score += 15
         
         # Record suspicious activity
@@ -155,42 +213,44 @@ class SecurityManager:
             # Block if too suspicious
             if suspicious_score > 20:
                 if ip_address:
-                    self.blocked_ips.add(ip_address)
+                    self.block_ip(ip_address)
                 return True
         
         return False
     
+    def block_ip(self, ip_address: str):
+        """Block an IP for ip_block_duration, across workers when Redis is configured"""
+        self.blocked_ips.add(ip_address)
+        if not self.redis:
+            return
+        try:
+            self.redis.set(f"blocked:{ip_address}", 1, ex=self.ip_block_duration)
+        except redis.RedisError as e:
+            print(f"Failed to record blocked IP in Redis: {str(e)}")
+    
     def is_ip_blocked(self, ip_address: str) -> bool:
         """Check if IP is blocked"""
-        return ip_address in self.blocked_ips
+        if ip_address in self.blocked_ips:
+            return True
+        if not self.redis:
+            return False
+        with self._blocked_cache_lock:
+            blocked = self._blocked_cache.get(ip_address)
+        if blocked is None:
+            try:
+                blocked = bool(self.redis.exists(f"blocked:{ip_address}"))
+            except redis.RedisError:
+                return False
+            with self._blocked_cache_lock:
+                self._blocked_cache[ip_address] = blocked
+        return blocked
     
     def validate_session(self, session_id: str) -> bool:
         """Validate session ID format"""
-        # UUID format validation
-        uuid_pattern = r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$'
-        return bool(re.match(uuid_pattern, session_id))
-    
-    def sanitize_context(self, context: Dict[str, Any]) -> Dict[str, Any]:
-        """Sanitize conversation context"""
-        if not context:
-            return {}
-        
-        sanitized_context = {}
-        
-        for key, value in context.items():
-            if isinstance(value, str):
-                sanitized_context[key] = self.sanitize_input(value)
-            elif isinstance(value, dict):
-                sanitized_context[key] = self.sanitize_context(value)
-            elif isinstance(value, list):
-                sanitized_context[key] = [
-                    self.sanitize_input(item) if isinstance(item, str) else item
-                    for item in value
-                ]
-            else:
-                sanitized_context[key] = value
-        
-        return sanitized_context
+        # Only the two possible lengths can match, so reject anything else before the regex
+        if len(session_id) not in (22, 36):
+            return False
+        return _SESSION_ID_RE.fullmatch(session_id) is not None
     
     def get_security_stats(self) -> Dict[str, Any]:
         """Get security statistics"""
@@ -199,8 +259,8 @@ class SecurityManager:
         
         # Count active requests
         active_requests = 0
-        for requests in self.request_counts.values():
-            active_requests += len([req for req in requests if req > cutoff_time])
+        for key in list(self.request_counts):
+            active_requests += len(self._prune_requests(key, cutoff_time))
         
         return {
             "blocked_ips": len(self.blocked_ips),
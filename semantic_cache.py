@@ -0,0 +1,54 @@
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+import numpy as np
+
+class SemanticResponseCache:
+    """
+    In-memory cache of LLM responses looked up by embedding similarity.
+
+    Entries are only returned when the cosine similarity clears the threshold AND the
+    conversation chain (previous user turn + context) matches, so follow-ups like
+    "make it red" don't hit answers given in a different conversation.
+    """
+
+    def __init__(self, threshold: float = 0.92, max_entries: int = 10_000):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._matrix: Optional[np.ndarray] = None  # (max_entries, dim) unit vectors
+        self._slots: "OrderedDict[int, Tuple[str, Dict[str, Any]]]" = OrderedDict()  # LRU order
+        self._next_slot = 0
+
+    def _normalize(self, embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, embedding, chain_hash: str) -> Optional[Dict[str, Any]]:
+        """Return the cached response for the closest matching entry, if any"""
+        if self._matrix is None or not self._slots:
+            return None
+
+        # Brute-force cosine similarity; unused rows are zero and never match
+        similarities = self._matrix @ self._normalize(embedding)
+        candidates = np.flatnonzero(similarities >= self.threshold)
+        for slot in candidates[np.argsort(-similarities[candidates])]:
+            entry = self._slots.get(int(slot))
+            if entry and entry[0] == chain_hash:
+                self._slots.move_to_end(int(slot))
+                return entry[1]
+        return None
+
+    def add(self, embedding, chain_hash: str, response: Dict[str, Any]):
+        """Store a response, evicting the least recently used entry when full"""
+        vector = self._normalize(embedding)
+        if self._matrix is None:
+            self._matrix = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+
+        if self._next_slot < self.max_entries:
+            slot = self._next_slot
+            self._next_slot += 1
+        else:
+            slot, _ = self._slots.popitem(last=False)
+
+        self._matrix[slot] = vector
+        self._slots[slot] = (chain_hash, response)
@@ -16,15 +16,19 @@ def create_database():
     
     # Create connection URL without database name
     base_url = SQLALCHEMY_DATABASE_URL.rsplit('/', 1)[0]
-    engine = create_engine(f"{base_url}/postgres")
+    # CREATE DATABASE can't run inside a transaction
+    engine = create_engine(f"{base_url}/postgres", isolation_level="AUTOCOMMIT")
     
     try:
         with engine.connect() as conn:
             # Check if database exists
-            result = conn.execute(text(f"SELECT 1 FROM pg_database WHERE datname = '{db_name}'"))
+            result = conn.execute(
+                text("SELECT 1 FROM pg_database WHERE datname = :name"), {"name": db_name}
+            )
             if not result.fetchone():
-                # Create database
-                conn.execute(text(f"CREATE DATABASE {db_name}"))
+                # Create database (identifiers can't be bound, so quote the name)
+                quoted_name = conn.dialect.identifier_preparer.quote(db_name)
+                conn.execute(text(f"CREATE DATABASE {quoted_name}"))
                 print(f"Database '{db_name}' created successfully!")
             else:
                 print(f"Database '{db_name}' already exists.")
@@ -32,6 +36,8 @@ def create_database():
         print(f"Error connecting to PostgreSQL: {e}")
         print("Please make sure PostgreSQL is running and credentials are correct.")
         sys.exit(1)
+    finally:
+        engine.dispose()
 
 def create_tables():
     """Create all tables"""
@@ -0,0 +1,86 @@
+import queue
+import threading
+import time
+from sqlalchemy import insert
+from database import SessionLocal
+from models import Token
+from auth import token_row
+
+class TokenWriteBuffer:
+    """
+    Write-behind buffer for issued access tokens.
+
+    Tokens are queued and written by a background thread, so each login does not wait
+    for its own INSERT and COMMIT. The thread writes everything that arrives within
+    flush_interval as one multi-row INSERT and commits once. A queued token reaches the
+    database at most about flush_interval after it is issued.
+    """
+
+    def __init__(self, flush_interval: float = 0.05, max_batch: int = 500):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the writer thread (call once per process)"""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="token-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """Write out whatever is still queued and stop the writer thread"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread:
+            self._queue.put(None)
+            thread.join(timeout)
+
+    def enqueue(self, user_id: int, access_token: str):
+        """Queue an access token row; written immediately if the writer isn't running"""
+        if self._thread is None:
+            self._write([(user_id, access_token)])
+            return
+        self._queue.put((user_id, access_token))
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._write(batch)
+
+    def _write(self, batch):
+        db = SessionLocal()
+        try:
+            rows = [token_row(user_id, token, "access") for user_id, token in batch]
+            db.execute(insert(Token), rows)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            # The rows are only a record: access tokens authenticate from their JWT and are only
+            # revoked in bulk through token_version, so the batch is dropped, not retried
+            print(f"Failed to save {len(batch)} access token(s), dropping them: {str(e)}")
+        finally:
+            db.close()
+
+# Initialize global token write buffer
+token_write_buffer = TokenWriteBuffer()
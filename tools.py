@@ -1,13 +1,84 @@
+import ast
 import httpx
-import json
+import orjson
 import math
+import operator
 import re
 from typing import Dict, Any, List, Optional
 from datetime import datetime
+from functools import lru_cache
 import asyncio
+from cachetools import TTLCache
+
+# Node types a calculator expression may contain: numbers and arithmetic operators
+_ALLOWED_CALC_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Pow, ast.USub, ast.UAdd,
+)
+
+_CALC_BINARY_OPS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+    ast.Div: operator.truediv, ast.FloorDiv: operator.floordiv, ast.Pow: operator.pow,
+}
+_CALC_UNARY_OPS = {ast.USub: operator.neg, ast.UAdd: operator.pos}
+
+# Bounds that keep exponentiation from running (and allocating) without end
+_MAX_CALC_EXPONENT = 1000
+_MAX_CALC_POWER_BITS = 10_000
+
+@lru_cache(maxsize=512)
+def _parse_expression(expression: str) -> ast.Expression:
+    """Parse an arithmetic expression, rejecting anything but numbers and operators"""
+    tree = ast.parse(expression, mode="eval")
+    for node in ast.walk(tree):
+        if not isinstance(node, _ALLOWED_CALC_NODES):
+            raise ValueError(f"unsupported syntax: {type(node).__name__}")
+        if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise ValueError("only numbers are allowed")
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow):
+            # Exponents must be plain numbers within bounds, so no power towers
+            exponent = node.right
+            if isinstance(exponent, ast.UnaryOp):
+                exponent = exponent.operand
+            if not isinstance(exponent, ast.Constant) or abs(exponent.value) > _MAX_CALC_EXPONENT:
+                raise ValueError(f"exponents must be numbers no larger than {_MAX_CALC_EXPONENT}")
+    return tree
+
+def _evaluate(node: ast.AST):
+    """Evaluate a tree from _parse_expression, refusing powers with oversized results"""
+    if isinstance(node, ast.Expression):
+        return _evaluate(node.body)
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, ast.UnaryOp):
+        return _CALC_UNARY_OPS[type(node.op)](_evaluate(node.operand))
+    left, right = _evaluate(node.left), _evaluate(node.right)
+    if (isinstance(node.op, ast.Pow) and isinstance(left, int) and isinstance(right, int)
+            and left.bit_length() * right > _MAX_CALC_POWER_BITS):
+        raise ValueError("result is too large")
+    return _CALC_BINARY_OPS[type(node.op)](left, right)
 
 class ChatbotTools:
     def __init__(self):
+        # Tools whose output is already a complete, user-ready answer; when a turn only
+        # calls these, the output is returned as-is instead of asking the model to reword it.
+        # weather_search isn't one until it has a real API key: its placeholder message is
+        # meant for developers and needs rewording for users.
+        self.direct_reply_tools = {"calculate", "get_current_time"}
+        
+        self._client: Optional[httpx.AsyncClient] = None
+        # Successful API payloads by normalized query/location; results repeat across users
+        self._search_cache = TTLCache(maxsize=1024, ttl=60)
+        self._weather_cache = TTLCache(maxsize=1024, ttl=600)
+        
+        # Tool name -> (method, argument names in call order, whether it's a coroutine)
+        self._dispatch = {
+            "web_search": (self.web_search, ("query",), True),
+            "calculate": (self.calculate, ("expression",), False),
+            "get_current_time": (self.get_current_time, (), False),
+            "weather_search": (self.weather_search, ("location",), True),
+        }
+        
         self.tools = [
             {
                 "type": "function",
@@ -74,6 +145,21 @@ class ChatbotTools:
             }
         ]
     
+    def _get_client(self) -> httpx.AsyncClient:
+        """Shared HTTP client for the web tools, so connections are reused across calls"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=5.0,
+                limits=httpx.Limits(max_keepalive_connections=10, max_connections=50)
+            )
+        return self._client
+    
+    async def aclose(self):
+        """Close the shared HTTP client, if it was ever built"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
     def get_tools(self) -> List[Dict[str, Any]]:
         """Get all available tools"""
         return self.tools
@@ -82,8 +168,10 @@ class ChatbotTools:
         """Search the web for information"""
         try:
             # Using DuckDuckGo Instant Answer API (free, no API key required)
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
+            cache_key = query.strip().lower()
+            data = self._search_cache.get(cache_key)
+            if data is None:
+                response = await self._get_client().get(
                     "https://api.duckduckgo.com/",
                     params={
                         "q": query,
@@ -92,19 +180,22 @@ class ChatbotTools:
                         "skip_disambig": "1"
                     }
                 )
-                
                 if response.status_code == 200:
-                    data = response.json()
-                    
-                    if data.get("Abstract"):
-                        return f"Search results for '{query}':\n\n{data['Abstract']}\n\nSource: {data.get('AbstractURL', 'N/A')}"
-                    elif data.get("Answer"):
-                        return f"Answer for '{query}':\n\n{data['Answer']}"
-                    else:
-                        return f"I couldn't find specific information for '{query}'. You might want to try a different search term or check a specific website."
+                    # Keep only the fields used below; the full payload is mostly related topics
+                    payload = orjson.loads(response.content)
+                    data = {key: payload[key] for key in ("Abstract", "AbstractURL", "Answer") if key in payload}
+                    self._search_cache[cache_key] = data
+            
+            if data is not None:
+                if data.get("Abstract"):
+                    return f"Search results for '{query}':\n\n{data['Abstract']}\n\nSource: {data.get('AbstractURL', 'N/A')}"
+                elif data.get("Answer"):
+                    return f"Answer for '{query}':\n\n{data['Answer']}"
                 else:
-                    return f"Sorry, I couldn't perform the web search for '{query}' at the moment."
-                    
+                    return f"I couldn't find specific information for '{query}'. You might want to try a different search term or check a specific website."
+            else:
+                return f"Sorry, I couldn't perform the web search for '{query}' at the moment."
+                
         except Exception as e:
             return f"Error performing web search: {str(e)}"
     
@@ -114,8 +205,8 @@ class ChatbotTools:
             # Remove any potentially dangerous characters
             safe_expression = re.sub(r'[^0-9+\-*/().\s]', '', expression)
             
-            # Evaluate the expression
-            result = eval(safe_expression)
+            # Evaluate the expression (parsed and checked once per distinct expression)
+            result = _evaluate(_parse_expression(safe_expression.strip()))
             
             return f"Calculation: {expression} = {result}"
             
@@ -136,8 +227,10 @@ class ChatbotTools:
             if api_key == "YOUR_OPENWEATHER_API_KEY":
                 return f"I can't get weather information for '{location}' right now. To enable weather searches, you'll need to get a free API key from openweathermap.org and update the code."
             
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
+            cache_key = location.strip().lower()
+            data = self._weather_cache.get(cache_key)
+            if data is None:
+                response = await self._get_client().get(
                     "http://api.openweathermap.org/data/2.5/weather",
                     params={
                         "q": location,
@@ -145,32 +238,30 @@ class ChatbotTools:
                         "units": "metric"
                     }
                 )
-                
                 if response.status_code == 200:
-                    data = response.json()
-                    temp = data["main"]["temp"]
-                    description = data["weather"][0]["description"]
-                    humidity = data["main"]["humidity"]
-                    
-                    return f"Weather in {location}:\nTemperature: {temp}°C\nCondition: {description}\nHumidity: {humidity}%"
-                else:
-                    return f"Sorry, I couldn't get weather information for '{location}'."
-                    
+                    data = orjson.loads(response.content)
+                    self._weather_cache[cache_key] = data
+            
+            if data is not None:
+                temp = data["main"]["temp"]
+                description = data["weather"][0]["description"]
+                humidity = data["main"]["humidity"]
+                
+                return f"Weather in {location}:\nTemperature: {temp}°C\nCondition: {description}\nHumidity: {humidity}%"
+            else:
+                return f"Sorry, I couldn't get weather information for '{location}'."
+                
         except Exception as e:
             return f"Error getting weather for '{location}': {str(e)}"
     
     async def execute_tool(self, tool_name: str, arguments: Dict[str, Any]) -> str:
         """Execute a specific tool"""
-        if tool_name == "web_search":
-            return await self.web_search(arguments.get("query", ""))
-        elif tool_name == "calculate":
-            return self.calculate(arguments.get("expression", ""))
-        elif tool_name == "get_current_time":
-            return self.get_current_time()
-        elif tool_name == "weather_search":
-            return await self.weather_search(arguments.get("location", ""))
-        else:
+        entry = self._dispatch.get(tool_name)
+        if entry is None:
             return f"Unknown tool: {tool_name}"
+        func, arg_names, is_async = entry
+        result = func(*(arguments.get(name, "") for name in arg_names))
+        return await result if is_async else result
 
 # Initialize global tools instance
 chatbot_tools = ChatbotTools() 
\ No newline at end of file
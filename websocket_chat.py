@@ -1,41 +1,126 @@
-import json
+import orjson
 import asyncio
 from typing import Dict, Any, Optional
 from fastapi import WebSocket, WebSocketDisconnect, Depends
 from sqlalchemy.orm import Session
-from datetime import datetime
+import time
 
-from database import get_db
+from database import SessionLocal
 from models import User, ChatSession, ChatMessage
-from auth import get_current_active_user_ws
+from auth import get_active_user_id_ws
 from chatbot_orchestrator import chatbot_orchestrator
 from security import security_manager
 
+def offer_frame(send_queue: asyncio.Queue, frame: str):
+    """Queue a frame that may be dropped (e.g. typing indicators) if the client is backed up"""
+    try:
+        send_queue.put_nowait(frame)
+    except asyncio.QueueFull:
+        pass
+
+def _dumps(payload: Dict[str, Any]) -> str:
+    """Serialize an outgoing frame; sent as text, so clients keep receiving text frames"""
+    return orjson.dumps(payload).decode()
+
+def _now_ms() -> int:
+    """Frame timestamp: Unix epoch milliseconds (UTC, unambiguous, e.g. `new Date(ts)` in JS)"""
+    return time.time_ns() // 1_000_000
+
+# Frames that never change, serialized once
+_TYPING_FRAME = _dumps({"type": "typing", "message": "AI is thinking..."})
+_INVALID_SESSION_FRAME = _dumps({"type": "error", "message": "Invalid session"})
+_INVALID_MESSAGE_FRAME = _dumps({"type": "error", "message": "Invalid message content"})
+_INVALID_JSON_FRAME = _dumps({"type": "error", "message": "Invalid JSON"})
+
+# Messages longer than this are checked in a worker thread; the pattern scan over a
+# message near the 5000-char cap takes a couple of milliseconds
+INLINE_CHECK_MAX_LENGTH = 1000
+
+# Frames waiting to be written per connection; producers block (or drop) beyond this
+SEND_QUEUE_SIZE = 64
+
+class ConnectionState:
+    """Everything tracked for one live connection, looked up with a single dict access"""
+    __slots__ = ("websocket", "session_id", "send_queue", "writer_task")
+    
+    def __init__(self, websocket: WebSocket, send_queue: asyncio.Queue):
+        self.websocket = websocket
+        self.session_id: Optional[str] = None
+        self.send_queue = send_queue
+        self.writer_task: Optional[asyncio.Task] = None
+
 class ConnectionManager:
+    """
+    Tracks live WebSocket connections. Each connection has a bounded send queue
+    drained by its own writer task, so handlers hand off frames instead of waiting
+    on a slow client's socket, and the writer is the only task sending on it.
+    """
     def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-        self.user_sessions: Dict[str, str] = {}  # user_id -> session_id
+        self.connections: Dict[int, ConnectionState] = {}  # user_id -> latest connection
     
-    async def connect(self, websocket: WebSocket, user_id: str):
+    async def connect(self, websocket: WebSocket, user_id: int) -> ConnectionState:
+        """Accept the connection, start its writer and return its state"""
         await websocket.accept()
-        self.active_connections[user_id] = websocket
+        connection = ConnectionState(websocket, asyncio.Queue(maxsize=SEND_QUEUE_SIZE))
+        connection.writer_task = asyncio.create_task(self._writer(websocket, connection.send_queue))
+        self.connections[user_id] = connection
+        return connection
+    
+    async def _writer(self, websocket: WebSocket, send_queue: asyncio.Queue):
+        """Send queued frames in order; runs until disconnect cancels it"""
+        closed = False
+        while True:
+            frame = await send_queue.get()
+            if closed:
+                continue
+            try:
+                await websocket.send_text(frame)
+            except Exception:
+                # Connection gone; keep draining so producers never block on a full
+                # queue, until the read loop notices and disconnects
+                closed = True
     
-    def disconnect(self, user_id: str):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-        if user_id in self.user_sessions:
-            del self.user_sessions[user_id]
+    def disconnect(self, user_id: int, connection: ConnectionState):
+        """Forget a closed connection, unless the user has since connected again"""
+        connection.writer_task.cancel()
+        if self.connections.get(user_id) is connection:
+            del self.connections[user_id]
     
-    async def send_personal_message(self, message: str, user_id: str):
-        if user_id in self.active_connections:
-            await self.active_connections[user_id].send_text(message)
+    async def send_personal_message(self, message: str, user_id: int):
+        connection = self.connections.get(user_id)
+        if connection is not None:
+            await connection.send_queue.put(message)
     
     async def broadcast(self, message: str):
-        for connection in self.active_connections.values():
-            await connection.send_text(message)
+        """Queue an already-serialized frame for every connection concurrently"""
+        # return_exceptions so one failing connection doesn't abort the rest of the fan-out
+        await asyncio.gather(
+            *(connection.send_queue.put(message) for connection in list(self.connections.values())),
+            return_exceptions=True
+        )
+    
+    async def broadcast_json(self, payload: Dict[str, Any]):
+        """Serialize a frame once and send it to every connection"""
+        await self.broadcast(_dumps(payload))
 
 manager = ConnectionManager()
 
+# A connection can stay open for hours, so it never holds a database session of its own:
+# each setup step and each message gets a short-lived one, returned to the pool when done
+
+def _authenticate(token: str) -> Optional[int]:
+    """get_active_user_id_ws with its own database session"""
+    with SessionLocal() as db:
+        return get_active_user_id_ws(token, db)
+
+def _open_chat_session(user_id: int, session_id: Optional[str]) -> Optional[str]:
+    """Id of the user's session session_id (None if it isn't theirs), or of a new session"""
+    with SessionLocal() as db:
+        if session_id:
+            chat_session = chatbot_orchestrator.get_session_for_user(db, session_id, user_id)
+            return chat_session.session_id if chat_session else None
+        return chatbot_orchestrator.create_session(db, user_id).session_id
+
 async def websocket_endpoint(
     websocket: WebSocket,
     token: str,
@@ -44,37 +129,32 @@ async def websocket_endpoint(
     """
     WebSocket endpoint for real-time chat
     """
+    user_id = None
+    connection = None
     try:
-        # Get database session
-        db = next(get_db())
-        
-        # Authenticate user
-        user = get_current_active_user_ws(token, db)
-        if not user:
+        # Authenticate user (blocking DB work runs off the event loop)
+        user_id = await asyncio.to_thread(_authenticate, token)
+        if user_id is None:
             await websocket.close(code=4001, reason="Authentication failed")
             return
         
-        # Connect to WebSocket
-        await manager.connect(websocket, str(user.id))
+        # Connect to WebSocket; frames go through this connection's send queue
+        connection = await manager.connect(websocket, user_id)
+        send_queue = connection.send_queue
         
         # Create or get chat session
-        if session_id:
-            chat_session = chatbot_orchestrator.get_session(db, session_id)
-            if not chat_session or chat_session.user_id != user.id:
-                await websocket.send_text(json.dumps({
-                    "type": "error",
-                    "message": "Invalid session"
-                }))
-                await websocket.close()
-                return
-        else:
-            chat_session = chatbot_orchestrator.create_session(db, user.id)
-            session_id = chat_session.session_id
+        opened_session_id = await asyncio.to_thread(_open_chat_session, user_id, session_id)
+        if opened_session_id is None:
+            await websocket.send_text(_INVALID_SESSION_FRAME)
+            await websocket.close()
+            return
+        session_id = opened_session_id
         
-        manager.user_sessions[str(user.id)] = session_id
+        connection.session_id = session_id
+        user_typing_frame = _dumps({"type": "user_typing", "user_id": str(user_id)})
         
         # Send welcome message
-        await websocket.send_text(json.dumps({
+        await send_queue.put(_dumps({
             "type": "session_created",
             "session_id": session_id,
             "message": "Connected to AI Chatbot. You can start chatting!"
@@ -83,65 +163,90 @@ async def websocket_endpoint(
         # Handle incoming messages
         while True:
             try:
-                data = await websocket.receive_text()
-                message_data = json.loads(data)
+                # Accept text or binary frames; orjson parses either without a decode step
+                frame = await websocket.receive()
+                if frame["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(frame.get("code", 1000))
+                data = frame.get("text")
+                message_data = orjson.loads(data if data is not None else frame.get("bytes") or b"")
+                if not isinstance(message_data, dict):
+                    await send_queue.put(_INVALID_MESSAGE_FRAME)
+                    continue
+                message_type = message_data.get("type")
                 
-                if message_data.get("type") == "message":
+                if message_type == "message":
                     user_message = message_data.get("content", "")
-                    
-                    # Security checks
-                    if not security_manager.validate_message(user_message):
-                        await websocket.send_text(json.dumps({
-                            "type": "error",
-                            "message": "Invalid message content"
-                        }))
+                    if not isinstance(user_message, str):
+                        await send_queue.put(_INVALID_MESSAGE_FRAME)
                         continue
                     
-                    # Sanitize input
-                    sanitized_message = security_manager.sanitize_input(user_message)
-                    
-                    # Send typing indicator
-                    await websocket.send_text(json.dumps({
-                        "type": "typing",
-                        "message": "AI is thinking..."
-                    }))
+                    # Security checks (long messages off the event loop)
+                    if len(user_message) > INLINE_CHECK_MAX_LENGTH:
+                        sanitized_message = await asyncio.to_thread(security_manager.clean_message, user_message)
+                    else:
+                        sanitized_message = security_manager.clean_message(user_message)
+                    if sanitized_message is None:
+                        await send_queue.put(_INVALID_MESSAGE_FRAME)
+                        continue
                     
-                    # Process message
-                    response = await chatbot_orchestrator.process_message(
-                        db=db,
-                        user_id=user.id,
-                        message=sanitized_message,
-                        session_id=session_id
-                    )
+                    # Database session for this turn only, released before waiting for the next message
+                    db = SessionLocal()
+                    try:
+                        if message_data.get("stream"):
+                            # Stream the reply as delta frames; the final message frame
+                            # below marks the end, so no typing indicator is needed
+                            async for event in chatbot_orchestrator.stream_message(
+                                db=db,
+                                user_id=user_id,
+                                message=sanitized_message,
+                                session_id=session_id
+                            ):
+                                if event["type"] == "delta":
+                                    await send_queue.put(_dumps({"type": "delta", "content": event["content"]}))
+                                elif event["type"] == "done":
+                                    response = event
+                        else:
+                            # Send typing indicator (droppable)
+                            offer_frame(send_queue, _TYPING_FRAME)
+                        
+                            # Process message
+                            response = await chatbot_orchestrator.process_message(
+                                db=db,
+                                user_id=user_id,
+                                message=sanitized_message,
+                                session_id=session_id
+                            )
+                    finally:
+                        await asyncio.to_thread(db.close)
                     
                     # Send response
-                    await websocket.send_text(json.dumps({
+                    await send_queue.put(_dumps({
                         "type": "message",
                         "role": "assistant",
                         "content": response["message"],
                         "session_id": session_id,
                         "tokens_used": response.get("tokens_used"),
-                        "timestamp": datetime.now().isoformat()
+                        "timestamp": _now_ms()
                     }))
                 
-                elif message_data.get("type") == "typing":
+                elif message_type == "typing":
                     # User is typing indicator
-                    await websocket.send_text(json.dumps({
-                        "type": "user_typing",
-                        "user_id": str(user.id)
-                    }))
+                    offer_frame(send_queue, user_typing_frame)
                 
-                elif message_data.get("type") == "ping":
+                elif message_type == "ping":
                     # Keep connection alive
-                    await websocket.send_text(json.dumps({
+                    offer_frame(send_queue, _dumps({
                         "type": "pong",
-                        "timestamp": datetime.now().isoformat()
+                        "timestamp": _now_ms()
                     }))
                 
             except WebSocketDisconnect:
                 break
+            except orjson.JSONDecodeError:
+                await send_queue.put(_INVALID_JSON_FRAME)
             except Exception as e:
-                await websocket.send_text(json.dumps({
+                print(f"WebSocket message error for user {user_id}: {str(e)}")
+                await send_queue.put(_dumps({
                     "type": "error",
                     "message": f"Error processing message: {str(e)}"
                 }))
@@ -150,7 +255,7 @@ async def websocket_endpoint(
         pass
     except Exception as e:
         try:
-            await websocket.send_text(json.dumps({
+            await websocket.send_text(_dumps({
                 "type": "error",
                 "message": f"Connection error: {str(e)}"
             }))
@@ -158,5 +263,5 @@ async def websocket_endpoint(
             pass
     finally:
         # Clean up connection
-        if hasattr(websocket, 'user_id'):
-            manager.disconnect(websocket.user_id) 
\ No newline at end of file
+        if connection is not None:
+            manager.disconnect(user_id, connection) 
\ No newline at end of file